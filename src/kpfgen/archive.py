@@ -0,0 +1,269 @@
+import sys
+import zipfile
+from pathlib import Path
+from typing import IO, TYPE_CHECKING, BinaryIO
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+# formats are usually compressed already, only deflated if a sample of them
+# deflates well
+COMPRESSED_SUFFIXES = frozenset(
+    (
+        ".epub",
+        ".gif",
+        ".jpeg",
+        ".jpg",
+        ".kpf",
+        ".mp3",
+        ".mp4",
+        ".png",
+        ".webp",
+        ".woff",
+        ".woff2",
+        ".zip",
+    )
+)
+# resource files of the KDF database don't have suffixes
+COMPRESSED_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", b"wOF")
+# members deflate to more than this fraction of their size are stored
+MAX_DEFLATE_RATIO = 0.95
+CHUNK_SIZE = 2**20
+# editor backups and swap files in META-INF aren't packed
+BACKUP_SUFFIXES = ("~", ".swp", ".swo", ".bak")
+# `write_compressed_member()` relies on `zipfile` internals of these CPython
+# versions, tests/test_archive.py checks them
+PRECOMPRESSED_VERSIONS = ((3, 11), (3, 12), (3, 13))
+PRECOMPRESSED_MEMBERS = (
+    sys.implementation.name == "cpython"
+    and sys.version_info[:2] in PRECOMPRESSED_VERSIONS
+)
+
+
+def write_kpf_archive(
+    dest: BinaryIO,
+    epub_source: BinaryIO | Path,
+    kpf_dir: Path,
+    compression_level: int = 6,
+) -> None:
+    """
+    Write KPF zip file to `dest`, which doesn't need to be seekable. The EPUB
+    file is copied from `epub_source` as "book.epub", or packed from the
+    files of an unpacked EPUB directory `epub_dir_members()` returns, other
+    files are in `kpf_dir`.
+
+    Files are compressed in a thread pool with zlib `compression_level`,
+    0 stores them.
+    """
+    import os
+    import shutil
+
+    with zipfile.ZipFile(dest, "w") as zf:
+        if isinstance(epub_source, Path):
+            write_epub_dir(zf, epub_source, compression_level)
+        else:
+            epub_size = epub_source.seek(0, os.SEEK_END)
+            epub_source.seek(0)
+            epub_info = zipfile.ZipInfo("book.epub")
+            epub_info.compress_type = zipfile.ZIP_STORED
+            epub_info.file_size = epub_size
+            with zf.open(epub_info, "w") as f:
+                shutil.copyfileobj(epub_source, f)
+        paths = []
+        for dir_path, dir_names, file_names in os.walk(kpf_dir):
+            dir_names.sort()
+            for name in sorted(file_names) + dir_names:
+                path = Path(dir_path) / name
+                paths.append((path, path.relative_to(kpf_dir).as_posix()))
+        write_members(zf, paths, compression_level)
+
+
+def write_epub_dir(zf: zipfile.ZipFile, epub_dir: Path, compression_level: int) -> None:
+    """
+    Zip EPUB directory into the "book.epub" member of `zf` in one pass, the
+    EPUB file isn't written to disk.
+    """
+    epub_info = zipfile.ZipInfo("book.epub")
+    # members of the EPUB file are already compressed, and its size is unknown
+    epub_info.compress_type = zipfile.ZIP_STORED
+    with zf.open(epub_info, "w", force_zip64=True) as f:
+        with zipfile.ZipFile(f, "w") as epub_zf:
+            # must be the first file and not compressed
+            epub_zf.writestr(
+                "mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED
+            )
+            write_members(epub_zf, epub_dir_members(epub_dir), compression_level)
+
+
+def epub_dir_members(epub_dir: Path) -> list[tuple[Path, str]]:
+    """
+    Return the files of an EPUB directory belong to the EPUB file: files in
+    "META-INF", the OPF file and manifest items. Version control
+    directories, editor backups and other files in the directory aren't
+    packed.
+    """
+    from .epub import get_epub_metadata
+
+    metadata = get_epub_metadata(epub_dir)
+    epub_dir = epub_dir.resolve()
+    paths = {metadata.opf_path.resolve()}
+    paths.update(metadata.item_path(item).resolve() for item in metadata.manifest.items)
+    for path in (epub_dir / "META-INF").rglob("*"):
+        relative_parts = path.relative_to(epub_dir).parts
+        if not any(
+            part.startswith(".") or part.endswith(BACKUP_SUFFIXES)
+            for part in relative_parts
+        ):
+            paths.add(path)
+    return sorted(
+        (path, path.relative_to(epub_dir).as_posix())
+        for path in paths
+        if path.is_relative_to(epub_dir)
+        and path.is_file()
+        and path != epub_dir / "mimetype"
+    )
+
+
+def write_members(
+    zf: zipfile.ZipFile, paths: list[tuple[Path, str]], compression_level: int
+) -> None:
+    """
+    Compress files in threads, zlib releases the GIL, and write them to `zf`
+    in order. A few files per thread are compressed ahead of the file being
+    written, directories are added when they're reached.
+    """
+    import os
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = os.cpu_count() or 1
+    pending: deque[tuple[Path, str, "Future | None"]] = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        for path, arcname in paths:
+            future = None
+            if not path.is_dir():
+                future = executor.submit(
+                    compress_member, path, arcname, compression_level
+                )
+            pending.append((path, arcname, future))
+            while len(pending) > workers * 2:
+                write_pending_member(zf, *pending.popleft())
+        while len(pending) > 0:
+            write_pending_member(zf, *pending.popleft())
+
+
+def write_pending_member(
+    zf: zipfile.ZipFile, path: Path, arcname: str, future: "Future | None"
+) -> None:
+    if future is None:
+        zf.write(path, arcname)
+        return
+    info, data = future.result()
+    with data:
+        if PRECOMPRESSED_MEMBERS:
+            write_compressed_member(zf, info, data)
+        else:
+            # compressed again with the method the worker chose
+            zf.write(path, arcname, info.compress_type)
+
+
+def compress_member(
+    path: Path, arcname: str, compression_level: int
+) -> tuple[zipfile.ZipInfo, IO[bytes]]:
+    """
+    Deflate file to a spooled temporary file, or copy it if the file is
+    empty, or it or its sample deflates to more than `MAX_DEFLATE_RATIO` of
+    its size.
+    """
+    import tempfile
+
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    data = tempfile.SpooledTemporaryFile(2**26)
+    with path.open("rb") as f:
+        head = f.read(CHUNK_SIZE)
+        deflate = compression_level > 0 and should_deflate(
+            path.suffix.lower(), head, compression_level
+        )
+        if deflate:
+            info.CRC, info.compress_size = copy_member(f, head, data, compression_level)
+            if info.compress_size > info.file_size * MAX_DEFLATE_RATIO:
+                deflate = False
+                f.seek(0)
+                head = f.read(CHUNK_SIZE)
+                data.seek(0)
+                data.truncate()
+        if not deflate:
+            info.CRC, info.compress_size = copy_member(f, head, data, None)
+    info.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+    data.seek(0)
+    return info, data
+
+
+def should_deflate(suffix: str, head: bytes, compression_level: int) -> bool:
+    """
+    Deflate a sample of the first chunk if the suffix or signature is an
+    already compressed format, other files are deflated.
+    """
+    import zlib
+
+    if len(head) == 0:
+        return False
+    if (
+        suffix not in COMPRESSED_SUFFIXES
+        and not head.startswith(COMPRESSED_SIGNATURES)
+        and head[8:12] != b"WEBP"
+    ):
+        return True
+    sample = head[: 2**16]
+    deflated_size = len(zlib.compress(sample, compression_level))
+    return deflated_size <= len(sample) * MAX_DEFLATE_RATIO
+
+
+def copy_member(
+    f: IO[bytes], head: bytes, data: IO[bytes], compression_level: int | None
+) -> tuple[int, int]:
+    """
+    Copy `head` and the rest of `f` to `data`, deflate them if
+    `compression_level` isn't `None`. Return CRC-32 of the file and the
+    number of bytes written.
+    """
+    import zlib
+
+    compressor = None
+    if compression_level is not None:
+        # raw deflate stream without zlib header, same as `zipfile`
+        compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -15)
+    crc = 0
+    chunk = head
+    while len(chunk) > 0:
+        crc = zlib.crc32(chunk, crc)
+        data.write(chunk if compressor is None else compressor.compress(chunk))
+        chunk = f.read(CHUNK_SIZE)
+    if compressor is not None:
+        data.write(compressor.flush())
+    return crc, data.tell()
+
+
+def write_compressed_member(
+    zf: zipfile.ZipFile, info: zipfile.ZipInfo, data: IO[bytes]
+) -> None:
+    """
+    Write member `compress_member()` created, the local header has the
+    CRC and sizes and doesn't need a data descriptor, same as
+    `ZipFile.writestr()`.
+
+    `ZipFile` can't write data compressed already, the member is appended
+    like `ZipFile.write()` does by updating the private `fp`, `filelist`,
+    `NameToInfo` and `start_dir` attributes. Only used on the versions in
+    `PRECOMPRESSED_MEMBERS`.
+    """
+    import shutil
+    from typing import cast
+
+    fp = cast(IO[bytes], zf.fp)
+    info.header_offset = fp.tell()
+    fp.write(info.FileHeader())
+    shutil.copyfileobj(data, fp)
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf.start_dir = fp.tell()  # type: ignore[attr-defined]
@@ -0,0 +1,396 @@
+"""
+Generate synthetic EPUB files and benchmark the conversion stages.
+
+$ python -m kpfgen.benchmark --no-browser -o results.json
+$ python -m kpfgen.benchmark --no-browser --baseline results.json
+"""
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+
+@dataclass
+class BenchmarkSpec:
+    chapters: int = 10
+    paragraphs: int = 50
+    depth: int = 1
+    images: int = 2
+    image_size: int = 600
+    toc_depth: int = 2
+    seed: int = 0
+
+
+PRESETS = {
+    "small": BenchmarkSpec(chapters=5, paragraphs=20, images=1),
+    "medium": BenchmarkSpec(),
+    "large": BenchmarkSpec(chapters=100, paragraphs=200, images=20),
+    "deep": BenchmarkSpec(chapters=10, paragraphs=100, depth=8, toc_depth=4),
+    "images": BenchmarkSpec(chapters=10, paragraphs=10, images=100, image_size=1600),
+}
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud"
+).split()
+
+
+def generate_epub(spec: BenchmarkSpec, epub_path: Path) -> None:
+    import random
+    import zipfile
+
+    rng = random.Random(spec.seed)
+    with zipfile.ZipFile(epub_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        zf.writestr(
+            "META-INF/container.xml",
+            """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf"
+     media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>""",
+        )
+        zf.writestr("OEBPS/style.css", "p { text-indent: 1em; margin: 0 }\n")
+        image_chapters = [i % spec.chapters for i in range(spec.images)]
+        for image_index in range(spec.images):
+            zf.writestr(
+                f"OEBPS/images/image{image_index}.jpg",
+                create_image(rng, spec.image_size),
+            )
+        for chapter in range(spec.chapters):
+            images = [i for i, c in enumerate(image_chapters) if c == chapter]
+            zf.writestr(
+                f"OEBPS/chapter{chapter}.xhtml",
+                create_chapter(rng, spec, chapter, images),
+            )
+        zf.writestr("OEBPS/nav.xhtml", create_nav(spec))
+        zf.writestr("OEBPS/content.opf", create_opf(spec))
+
+
+def create_image(rng, size: int) -> bytes:
+    from io import BytesIO
+
+    from PIL import Image
+
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    im = Image.linear_gradient("L").resize((size, size * 4 // 3)).convert("RGB")
+    im.paste(color, (0, 0, size // 2, size // 2))
+    buffer = BytesIO()
+    im.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+def create_chapter(rng, spec: BenchmarkSpec, chapter: int, images: list[int]) -> str:
+    body = [f"<h1>Chapter {chapter}</h1>"]
+    headings = max(spec.toc_depth - 1, 0)
+    for index in range(spec.paragraphs):
+        if headings > 0 and index % max(spec.paragraphs // 4, 1) == 0:
+            level = 2 + index % headings
+            body.append(f'<h{level} id="s{index}">Section {index}</h{level}>')
+        text = " ".join(rng.choices(WORDS, k=rng.randint(20, 120)))
+        paragraph = f"<p>{text.capitalize()}.</p>"
+        for level in range(spec.depth - 1):
+            paragraph = f'<div class="d{level}">{paragraph}</div>'
+        body.append(paragraph)
+    for image_index in images:
+        body.append(
+            f'<figure><img src="images/image{image_index}.jpg" '
+            f'alt="Image {image_index}"/></figure>'
+        )
+    body_str = "\n".join(body)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">
+<head><title>Chapter {chapter}</title>
+<link rel="stylesheet" type="text/css" href="style.css"/></head>
+<body>
+{body_str}
+</body>
+</html>"""
+
+
+def create_nav(spec: BenchmarkSpec) -> str:
+    def nav_list(chapter: int, level: int) -> str:
+        if level > spec.toc_depth:
+            return ""
+        items = []
+        for index in range(0, spec.paragraphs, max(spec.paragraphs // 4, 1)):
+            items.append(
+                f'<li><a href="chapter{chapter}.xhtml#s{index}">'
+                f"Section {index}</a>{nav_list(chapter, level + 1)}</li>"
+            )
+        return f"<ol>{''.join(items)}</ol>"
+
+    entries = "".join(
+        f'<li><a href="chapter{chapter}.xhtml">Chapter {chapter}</a>'
+        f"{nav_list(chapter, 2)}</li>"
+        for chapter in range(spec.chapters)
+    )
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml"
+ xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="en">
+<head><title>Contents</title></head>
+<body><nav epub:type="toc"><ol>{entries}</ol></nav></body>
+</html>"""
+
+
+def create_opf(spec: BenchmarkSpec) -> str:
+    manifest = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" '
+        'properties="nav"/>',
+        '<item id="css" href="style.css" media-type="text/css"/>',
+    ]
+    manifest.extend(
+        f'<item id="ch{c}" href="chapter{c}.xhtml" media-type="application/xhtml+xml"/>'
+        for c in range(spec.chapters)
+    )
+    manifest.extend(
+        f'<item id="img{i}" href="images/image{i}.jpg" media-type="image/jpeg"/>'
+        for i in range(spec.images)
+    )
+    spine = "".join(f'<itemref idref="ch{c}"/>' for c in range(spec.chapters))
+    cover_meta = '<meta name="cover" content="img0"/>' if spec.images > 0 else ""
+    manifest_str = "\n    ".join(manifest)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">kpfgen-benchmark</dc:identifier>
+    <dc:title>kpfgen benchmark</dc:title>
+    <dc:language>en</dc:language>
+    <dc:creator>kpfgen</dc:creator>
+    {cover_meta}
+  </metadata>
+  <manifest>
+    {manifest_str}
+  </manifest>
+  <spine>{spine}</spine>
+</package>"""
+
+
+def measure(function: Callable[[], Any], repeat: int) -> tuple[dict[str, Any], Any]:
+    """
+    Run `function` `repeat` times for timing, then once more under
+    `tracemalloc` for the peak Python memory usage.
+    """
+    import statistics
+    import time
+    import tracemalloc
+
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "time": statistics.median(times),
+        "times": times,
+        "peak_memory": peak_memory,
+    }, result
+
+
+def run_case(spec: BenchmarkSpec, repeat: int, browser: bool) -> dict[str, Any]:
+    import shutil
+    import tempfile
+    from typing import cast
+
+    from selenium.webdriver.remote.webdriver import WebDriver
+
+    from .epub import extract_epub, get_epub_metadata
+    from .kdf import KDF
+    from .main import create_kpf
+    from .options import ConversionOptions
+    from .profiling import Profiler
+    from .static_render import StaticDriver
+
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_path = Path(tmpdir)
+        epub_path = tmp_path / "book.epub"
+        stages["generate_epub"], _ = measure(lambda: generate_epub(spec, epub_path), 1)
+        epub_dir = tmp_path / "epub"
+
+        def extract() -> None:
+            shutil.rmtree(epub_dir, ignore_errors=True)
+            extract_epub(epub_path, epub_dir)
+
+        stages["extract_epub"], _ = measure(extract, repeat)
+        stages["get_epub_metadata"], _ = measure(
+            lambda: get_epub_metadata(epub_dir), repeat
+        )
+
+        def create_static_kdf(options: ConversionOptions) -> Profiler:
+            kdf_dir = tmp_path / "kdf"
+            shutil.rmtree(kdf_dir, ignore_errors=True)
+            kdf_dir.mkdir()
+            profiler = Profiler()
+            kdf = KDF(profiler, cast(WebDriver, StaticDriver()), options)
+            kdf.create_kdf(epub_dir, kdf_dir / "book.kdf")
+            return profiler
+
+        for stage_name, options in (
+            ("create_kdf_static", ConversionOptions()),
+            # text packed into content fragments
+            ("create_kdf_static_content", ConversionOptions(content_fragments=True)),
+            ("create_kdf_static_optimized", ConversionOptions(optimize_kdf=True)),
+        ):
+            stages[stage_name], profiler = measure(
+                lambda: create_static_kdf(options), repeat
+            )
+            # stages inside `KDF.create_kdf` from the last timed run
+            for name, timing in profiler.report()["stages"].items():
+                stages[f"{stage_name}.{name}"] = {"time": timing["wall"]}
+            stages[stage_name]["kdf_bytes"] = profiler.counters["kdf_bytes"]
+            stages[stage_name]["fragments"] = sum(
+                stats.count for stats in profiler.fragments.values()
+            )
+            stages[f"{stage_name}.lookup"], _ = measure(
+                lambda: query_kdf(tmp_path / "kdf" / "book.kdf"), repeat
+            )
+
+        if browser:
+
+            def create_browser_kpf() -> Profiler:
+                profiler = Profiler()
+                create_kpf(epub_path, profiler)
+                return profiler
+
+            stages["create_kpf"], profiler = measure(create_browser_kpf, repeat)
+            stages["create_kpf"]["kpf_bytes"] = profiler.counters["kpf_bytes"]
+    return {"spec": asdict(spec), "stages": stages}
+
+
+def query_kdf(db_path: Path) -> None:
+    """
+    Find fragments by element type and parent fragment, like KDF readers.
+    """
+    import sqlite3
+
+    conn = sqlite3.connect(db_path)
+    try:
+        for (element_type,) in conn.execute(
+            "SELECT DISTINCT value FROM fragment_properties WHERE key = 'element_type'"
+        ).fetchall():
+            conn.execute(
+                "SELECT id FROM fragment_properties "
+                "WHERE key = 'element_type' AND value = ?",
+                (element_type,),
+            ).fetchall()
+        for (child_id,) in conn.execute(
+            "SELECT value FROM fragment_properties WHERE key = 'child' LIMIT 1000"
+        ).fetchall():
+            conn.execute(
+                "SELECT id FROM fragment_properties WHERE key = 'child' AND value = ?",
+                (child_id,),
+            ).fetchall()
+    finally:
+        conn.close()
+
+
+def compare(
+    results: dict[str, Any], baseline: dict[str, Any], threshold: float
+) -> list[str]:
+    """
+    Print the time ratio of every stage against the baseline, return the
+    stages slower than `1 + threshold`.
+    """
+    regressions = []
+    for case_name, case in results["cases"].items():
+        baseline_case = baseline.get("cases", {}).get(case_name)
+        if baseline_case is None:
+            continue
+        for stage_name, stage in case["stages"].items():
+            baseline_stage = baseline_case["stages"].get(stage_name)
+            if baseline_stage is None or baseline_stage["time"] == 0:
+                continue
+            ratio = stage["time"] / baseline_stage["time"]
+            name = f"{case_name}/{stage_name}"
+            print(
+                f"{name:<50} {baseline_stage['time']:>10.4f}s "
+                f"{stage['time']:>10.4f}s {ratio:>7.2f}x"
+            )
+            if ratio > 1 + threshold:
+                regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    import argparse
+    import json
+    import logging
+    import platform
+    import sys
+    from importlib.metadata import version
+
+    parser = argparse.ArgumentParser(prog="python -m kpfgen.benchmark")
+    parser.add_argument(
+        "--preset",
+        action="append",
+        choices=PRESETS,
+        help="Preset cases to run, default is all presets",
+    )
+    for name, value in asdict(BenchmarkSpec()).items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=int,
+            help=f"Run a custom case, default {name} is {value}",
+        )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--no-browser", action="store_true", help="Skip stages need Firefox"
+    )
+    parser.add_argument("-o", "--output", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Slowdown ratio counts as regression, default is 0.1",
+    )
+    args = parser.parse_args()
+
+    cases = {}
+    custom_spec = {
+        name: getattr(args, name)
+        for name in asdict(BenchmarkSpec())
+        if getattr(args, name) is not None
+    }
+    if len(custom_spec) > 0:
+        cases["custom"] = BenchmarkSpec(**custom_spec)
+    for preset in args.preset or ([] if len(cases) > 0 else PRESETS):
+        cases[preset] = PRESETS[preset]
+
+    results: dict[str, Any] = {
+        "kpfgen_version": version("kpfgen"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cases": {},
+    }
+    for name, spec in cases.items():
+        print(f"Running benchmark case {name}", file=sys.stderr)
+        results["cases"][name] = run_case(spec, args.repeat, not args.no_browser)
+
+    if args.output is not None:
+        with args.output.open("w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.baseline is not None:
+        with args.baseline.open() as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            logging.error("Regressions: %s", ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
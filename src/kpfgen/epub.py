@@ -1,12 +1,189 @@
+import re
+import zipfile
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import BinaryIO
 
+from lxml import etree
 
-def extract_epub(epub_path: Path, dest_path: Path) -> None:
-    import zipfile
+CSS_URL_PATTERN = re.compile(
+    r"""@import\s+(?:url\(\s*)?['"]?([^'")\s;]+)|url\(\s*['"]?([^'")]+?)['"]?\s*\)"""
+)
 
+
+def extract_epub(
+    epub_path: Path | BinaryIO, dest_path: Path, max_size: int = 0, max_members: int = 0
+) -> None:
+    """
+    Extract the OPF file, spine documents, navigation document and the
+    stylesheets and images they reference. Fonts, media and files not
+    referenced aren't used by the conversion.
+
+    Raise `ValueError` if the EPUB has more than `max_members` files or the
+    extracted files are larger than `max_size` bytes, 0 disables the limits.
+    """
     with zipfile.ZipFile(epub_path) as zf:
-        zf.extractall(dest_path)
+        if max_members > 0 and len(zf.infolist()) > max_members:
+            raise ValueError(f"EPUB has more than {max_members} files")
+        EPUBExtractor(zf, dest_path, max_size).extract_referenced()
+
+
+class EPUBExtractor:
+    """
+    Extract a zip member when it's first referenced, starting from the
+    container file, OPF file and spine. XHTML and CSS files are scanned for
+    references to stylesheets and images.
+    """
+
+    def __init__(self, zf: zipfile.ZipFile, dest_path: Path, max_size: int) -> None:
+        self.zf = zf
+        self.dest_path = dest_path
+        self.max_size = max_size
+        self.size = 0
+        self.members = {info.filename: info for info in zf.infolist()}
+        self.extracted: set[str] = set()
+        # member name: manifest media type
+        self.media_types: dict[str, str] = {}
+
+    def extract_referenced(self) -> None:
+        import posixpath
+        from urllib.parse import unquote
+
+        container_root = etree.fromstring(self.extract("META-INF/container.xml"))
+        opf_name = unquote(
+            container_root.find(".//n:rootfile", NAMESPACES).get("full-path")
+        )
+        if opf_name not in self.members:
+            # same fallback as `get_epub_metadata()`
+            opf_name = next(name for name in self.members if name.endswith(opf_name))
+        opf_root = etree.fromstring(self.extract(opf_name))
+        opf_dir = posixpath.dirname(opf_name)
+        manifest = parse_manifest(opf_root)
+
+        def member_name(item: ManifestItem) -> str:
+            return posixpath.normpath(posixpath.join(opf_dir, item.href))
+
+        for item in manifest.items:
+            self.media_types[member_name(item)] = item.media_type
+        for item in manifest.by_property.get("nav", []):
+            self.extract_document(member_name(item))
+        cover_item = get_cover_item(opf_root, manifest)
+        if cover_item is not None and member_name(cover_item) in self.members:
+            self.extract_member(member_name(cover_item))
+        for item in get_spine_items(opf_root, manifest):
+            self.extract_document(member_name(item))
+
+    def extract(self, name: str) -> bytes:
+        return self.extract_member(name).read_bytes()
+
+    def extract_member(self, name: str) -> Path:
+        info = self.members.get(name)
+        if info is None:
+            raise KeyError(f"{name} isn't in the EPUB file")
+        path = self.dest_path / name
+        if name in self.extracted:
+            return path
+        # `ZipExtFile` doesn't read more than `file_size` bytes
+        self.size += info.file_size
+        if self.max_size > 0 and self.size > self.max_size:
+            raise ValueError(f"EPUB files are larger than {self.max_size} bytes")
+        self.extracted.add(name)
+        return Path(self.zf.extract(info, self.dest_path))
+
+    def extract_document(self, name: str) -> None:
+        """
+        Extract XHTML file and the stylesheets and images it references.
+        """
+        if name in self.extracted or name not in self.members:
+            return
+        parser = etree.XMLParser(recover=True, resolve_entities=False)
+        root = etree.fromstring(self.extract(name), parser)
+        if root is None:
+            return
+        for element in root.iter(etree.Element):
+            tag = etree.QName(element).localname
+            if tag == "link" and "stylesheet" in element.get("rel", "").split():
+                self.extract_stylesheet(resolve_member(name, element.get("href")))
+            elif tag == "img":
+                self.extract_image(resolve_member(name, element.get("src")))
+            elif tag == "image":
+                href = element.get(
+                    "href", element.get("{http://www.w3.org/1999/xlink}href")
+                )
+                self.extract_image(resolve_member(name, href))
+            elif tag == "style" and element.text is not None:
+                self.extract_css_references(name, element.text)
+
+    def extract_stylesheet(self, name: str | None) -> None:
+        if name is None or name in self.extracted or name not in self.members:
+            return
+        css = self.extract(name).decode(errors="replace")
+        self.extract_css_references(name, css)
+
+    def extract_css_references(self, name: str, css: str) -> None:
+        for match in CSS_URL_PATTERN.finditer(css):
+            import_url, url = match.groups()
+            if import_url is not None:
+                self.extract_stylesheet(resolve_member(name, import_url))
+            else:
+                self.extract_image(resolve_member(name, url))
+
+    def extract_image(self, name: str | None) -> None:
+        import mimetypes
+
+        if name is None or name in self.extracted or name not in self.members:
+            return
+        media_type = self.media_types.get(name) or mimetypes.guess_type(name)[0]
+        # fonts are also referenced with `url()`
+        if media_type is not None and media_type.startswith("image/"):
+            self.extract_member(name)
+
+
+def resolve_member(base_name: str, href: str | None) -> str | None:
+    """
+    Return zip member name of a relative URL in the `base_name` member.
+    """
+    import posixpath
+    from urllib.parse import unquote, urlsplit
+
+    if href is None:
+        return None
+    url = urlsplit(href.strip())
+    if url.scheme != "" or url.netloc != "" or url.path == "":
+        return None
+    return posixpath.normpath(
+        posixpath.join(posixpath.dirname(base_name), unquote(url.path))
+    )
+
+
+@dataclass
+class ManifestItem:
+    id: str
+    # decoded and relative to the OPF file
+    href: str
+    media_type: str
+    properties: frozenset[str] = frozenset()
+
+
+@dataclass
+class Manifest:
+    """
+    OPF manifest items indexed by id and properties.
+    """
+
+    items: list[ManifestItem] = field(default_factory=list)
+    by_id: dict[str, ManifestItem] = field(default_factory=dict)
+    by_property: dict[str, list[ManifestItem]] = field(default_factory=dict)
+
+    def add(self, item: ManifestItem) -> None:
+        self.items.append(item)
+        self.by_id.setdefault(item.id, item)
+        for item_property in item.properties:
+            self.by_property.setdefault(item_property, []).append(item)
+
+    def first_with_property(self, item_property: str) -> ManifestItem | None:
+        items = self.by_property.get(item_property)
+        return None if items is None else items[0]
 
 
 @dataclass
@@ -19,6 +196,11 @@ class EPUBMetadata:
     cover_path: Path | None = None
     spine_paths: list[Path] = field(default_factory=list)
     toc: Path | None = None
+    opf_path: Path = Path()
+    manifest: Manifest = field(default_factory=Manifest)
+
+    def item_path(self, item: ManifestItem) -> Path:
+        return self.opf_path.parent / item.href
 
 
 NAMESPACES = {
@@ -33,8 +215,6 @@ NAMESPACES = {
 def get_epub_metadata(epub_dir: Path) -> EPUBMetadata:
     from urllib.parse import unquote
 
-    from lxml import etree
-
     container_root = etree.parse(epub_dir / "META-INF" / "container.xml")
     opf_path_str = unquote(
         container_root.find(".//n:rootfile", NAMESPACES).get("full-path")
@@ -42,8 +222,15 @@ def get_epub_metadata(epub_dir: Path) -> EPUBMetadata:
     opf_path = epub_dir / opf_path_str
     if not opf_path.exists():
         opf_path = next(epub_dir.rglob(opf_path_str))
-    opf_root = etree.parse(opf_path)
-    metadata = EPUBMetadata()
+    return read_opf_metadata(etree.parse(opf_path), opf_path)
+
+
+def read_opf_metadata(opf_root, opf_path: Path) -> EPUBMetadata:
+    """
+    Read metadata of the parsed OPF file, paths are relative to the parent
+    of `opf_path`.
+    """
+    metadata = EPUBMetadata(opf_path=opf_path, manifest=parse_manifest(opf_root))
     for element_type in ("language", "title", "description", "publisher"):
         for element in opf_root.iterfind(
             f"opf:metadata/dc:{element_type}", namespaces=NAMESPACES
@@ -52,25 +239,56 @@ def get_epub_metadata(epub_dir: Path) -> EPUBMetadata:
     author_element = opf_root.find("opf:metadata/dc:creator", NAMESPACES)
     if author_element is not None:
         metadata.author = author_element.text
-    cover_element = opf_root.find('opf:metadata/opf:meta[@name="cover"]', NAMESPACES)
-    if cover_element is not None:
-        cover_id = cover_element.get("content")
-        metadata.cover_path = opf_path.parent / opf_root.find(
-            f'opf:manifest/opf:item[@id="{cover_id}"]', NAMESPACES
-        ).get("href")
-    get_epub_spine(opf_root, metadata, opf_path)
-    toc_element = opf_root.find('opf:manifest/opf:item[@properties="nav"]', NAMESPACES)
-    if toc_element is not None:
-        metadata.toc = opf_path.parent / toc_element.get("href")
+    cover_item = get_cover_item(opf_root, metadata.manifest)
+    if cover_item is not None:
+        metadata.cover_path = metadata.item_path(cover_item)
+    get_epub_spine(opf_root, metadata)
+    toc_item = metadata.manifest.first_with_property("nav")
+    if toc_item is not None:
+        metadata.toc = metadata.item_path(toc_item)
 
     return metadata
 
 
-def get_epub_spine(opf_root, metadata: EPUBMetadata, opf_path: Path) -> None:
-    for spine_item in opf_root.iterfind("opf:spine/opf:itemref", NAMESPACES):
-        manifest_item_id = spine_item.get("idref", "")
-        manifest_item = opf_root.find(
-            f'opf:manifest/opf:item[@id="{manifest_item_id}"]', NAMESPACES
+def parse_manifest(opf_root) -> Manifest:
+    import posixpath
+    from urllib.parse import unquote
+
+    manifest = Manifest()
+    for element in opf_root.iterfind("opf:manifest/opf:item", NAMESPACES):
+        manifest.add(
+            ManifestItem(
+                element.get("id", ""),
+                posixpath.normpath(unquote(element.get("href", ""))),
+                element.get("media-type", ""),
+                frozenset(element.get("properties", "").split()),
+            )
         )
+    return manifest
+
+
+def get_cover_item(opf_root, manifest: Manifest) -> ManifestItem | None:
+    """
+    Find cover image from the EPUB 2 cover meta element or the EPUB 3
+    "cover-image" property.
+    """
+    cover_element = opf_root.find('opf:metadata/opf:meta[@name="cover"]', NAMESPACES)
+    if cover_element is not None:
+        cover_item = manifest.by_id.get(cover_element.get("content", ""))
+        if cover_item is not None:
+            return cover_item
+    return manifest.first_with_property("cover-image")
+
+
+def get_spine_items(opf_root, manifest: Manifest) -> list[ManifestItem]:
+    spine_items = []
+    for itemref in opf_root.iterfind("opf:spine/opf:itemref", NAMESPACES):
+        manifest_item = manifest.by_id.get(itemref.get("idref", ""))
         if manifest_item is not None:
-            metadata.spine_paths.append(opf_path.parent / manifest_item.get("href"))
+            spine_items.append(manifest_item)
+    return spine_items
+
+
+def get_epub_spine(opf_root, metadata: EPUBMetadata) -> None:
+    for manifest_item in get_spine_items(opf_root, metadata.manifest):
+        metadata.spine_paths.append(metadata.item_path(manifest_item))
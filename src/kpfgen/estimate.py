@@ -0,0 +1,329 @@
+"""
+Estimate conversion cost of an EPUB file without extracting or rendering it.
+
+$ kpfgen estimate book.epub
+$ python -m kpfgen.benchmark -o results.json
+$ kpfgen estimate book.epub --calibration results.json
+"""
+
+import zipfile
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import IO, Any, BinaryIO
+
+from lxml import etree
+
+TIME_FEATURES = ("spine_documents", "block_elements", "image_pixels")
+MEMORY_FEATURES = ("block_elements", "largest_image_pixels")
+
+
+@dataclass
+class EPUBCost:
+    spine_documents: int = 0
+    xhtml_bytes: int = 0
+    largest_document_bytes: int = 0
+    elements: int = 0
+    # block elements become structures of the KDF
+    block_elements: int = 0
+    text_characters: int = 0
+    # images referenced by spine documents and the cover
+    images: int = 0
+    image_pixels: int = 0
+    largest_image_pixels: int = 0
+    toc_entries: int = 0
+
+
+@dataclass
+class CostModel:
+    """
+    Linear models of conversion time (seconds) and peak memory (bytes),
+    feature name: coefficient, "" is the intercept.
+    """
+
+    time: dict[str, float] = field(default_factory=dict)
+    peak_memory: dict[str, float] = field(default_factory=dict)
+
+    def predict(self, cost: EPUBCost) -> dict[str, float]:
+        features = asdict(cost)
+        return {
+            name: max(
+                sum(
+                    coefficient * (features[feature] if feature != "" else 1)
+                    for feature, coefficient in coefficients.items()
+                ),
+                0.0,
+            )
+            for name, coefficients in (
+                ("time", self.time),
+                ("peak_memory", self.peak_memory),
+            )
+        }
+
+
+# `fit_cost_model()` of the "create_kdf_static" stage in
+# benchmarks/no-browser.json, the output of
+# `python -m kpfgen.benchmark --no-browser --repeat 3`. The static renderer
+# doesn't start Firefox, which takes most of the time and memory of a
+# conversion, so it's not an estimate of the conversion cost.
+STATIC_RENDER_COST_MODEL = CostModel(
+    time={
+        "": 0.0745,
+        "spine_documents": 0.00615,
+        "block_elements": 0.00346,
+        "image_pixels": 3.23e-10,
+    },
+    peak_memory={"": 1.92e6, "block_elements": 2230, "largest_image_pixels": 0.0886},
+)
+
+
+def estimate_epub(
+    epub_path: Path | BinaryIO, model: CostModel | None = None
+) -> dict[str, Any]:
+    """
+    Return `EPUBCost` of the EPUB file and the time and peak memory of the
+    static renderer as "static_render_estimate". The predicted conversion
+    cost "estimate" is only included if `model` is passed, fit it to
+    benchmark results of the browser stages.
+    """
+    cost = scan_epub(epub_path)
+    result = asdict(cost) | {
+        "static_render_estimate": STATIC_RENDER_COST_MODEL.predict(cost)
+    }
+    if model is not None:
+        result["estimate"] = model.predict(cost)
+    return result
+
+
+def scan_epub(epub_path: Path | BinaryIO) -> EPUBCost:
+    """
+    Read the OPF file with `read_opf_metadata()`, then stream the spine
+    documents through `iterparse()` and read image sizes from their headers.
+    Files aren't extracted.
+    """
+    from urllib.parse import unquote
+
+    from .epub import NAMESPACES, read_opf_metadata
+
+    cost = EPUBCost()
+    with zipfile.ZipFile(epub_path) as zf:
+        members = {info.filename: info for info in zf.infolist()}
+        container_root = etree.fromstring(zf.read("META-INF/container.xml"))
+        opf_name = unquote(
+            container_root.find(".//n:rootfile", NAMESPACES).get("full-path")
+        )
+        if opf_name not in members:
+            opf_name = next(name for name in members if name.endswith(opf_name))
+        metadata = read_opf_metadata(
+            etree.fromstring(zf.read(opf_name)), Path(opf_name)
+        )
+        image_names = set()
+        if metadata.cover_path is not None:
+            image_names.add(member_name(metadata.cover_path))
+        for spine_path in metadata.spine_paths:
+            info = members.get(member_name(spine_path))
+            if info is None:
+                continue
+            cost.spine_documents += 1
+            cost.xhtml_bytes += info.file_size
+            cost.largest_document_bytes = max(
+                cost.largest_document_bytes, info.file_size
+            )
+            with zf.open(info) as f:
+                image_names.update(scan_document(f, info.filename, cost))
+        for name in image_names:
+            if name not in members:
+                continue
+            width, height = image_size(zf, members[name])
+            cost.images += 1
+            cost.image_pixels += width * height
+            cost.largest_image_pixels = max(cost.largest_image_pixels, width * height)
+        if metadata.toc is not None and member_name(metadata.toc) in members:
+            toc_root = etree.fromstring(zf.read(member_name(metadata.toc)))
+            cost.toc_entries = len(toc_root.findall(".//xml:nav//xml:a", NAMESPACES))
+    return cost
+
+
+def member_name(path: Path) -> str:
+    import posixpath
+
+    return posixpath.normpath(path.as_posix())
+
+
+def scan_document(f: IO[bytes], name: str, cost: EPUBCost) -> set[str]:
+    """
+    Count elements and text of a spine document, return the images it
+    references. Parsed elements are removed to keep memory usage low.
+    """
+    from .epub import resolve_member
+    from .static_render import BLOCK_TAGS
+
+    image_names = set()
+    href: str | None
+    for _, element in etree.iterparse(
+        f, events=("end",), recover=True, resolve_entities=False, huge_tree=True
+    ):
+        if not isinstance(element.tag, str):
+            continue
+        tag = etree.QName(element).localname
+        cost.elements += 1
+        href = None
+        if tag in BLOCK_TAGS:
+            cost.block_elements += 1
+        elif tag == "img":
+            href = element.get("src")
+        elif tag == "image":
+            href = element.get(
+                "href", element.get("{http://www.w3.org/1999/xlink}href")
+            )
+        if (image_name := resolve_member(name, href)) is not None:
+            image_names.add(image_name)
+        cost.text_characters += len((element.text or "").strip())
+        cost.text_characters += len((element.tail or "").strip())
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return image_names
+
+
+def image_size(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> tuple[int, int]:
+    """
+    Pillow only reads the image header.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    try:
+        with zf.open(info) as f, Image.open(f) as im:
+            return im.size
+    except (UnidentifiedImageError, OSError):
+        return 0, 0
+
+
+def fit_cost_model(results: dict[str, Any], stage: str = "create_kpf") -> CostModel:
+    """
+    Fit `CostModel` to the median time and peak memory of a stage in
+    benchmark results, default is `create_kpf`, which runs the browser.
+    Raise `ValueError` if a case doesn't have the stage. The EPUB files of
+    the benchmark cases are generated again to be scanned.
+    """
+    import tempfile
+
+    from .benchmark import BenchmarkSpec, generate_epub
+
+    costs = []
+    stages = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        epub_path = Path(tmpdir) / "book.epub"
+        for case in results["cases"].values():
+            if stage not in case["stages"]:
+                raise ValueError(
+                    f"Benchmark results don't have {stage} stage, run the "
+                    "benchmark without --no-browser"
+                )
+            generate_epub(BenchmarkSpec(**case["spec"]), epub_path)
+            costs.append(asdict(scan_epub(epub_path)))
+            stages.append(case["stages"][stage])
+    return CostModel(
+        time=least_squares(costs, [s["time"] for s in stages], TIME_FEATURES),
+        peak_memory=least_squares(
+            costs, [s["peak_memory"] for s in stages], MEMORY_FEATURES
+        ),
+    )
+
+
+def least_squares(
+    samples: list[dict[str, Any]], targets: list[float], features: tuple[str, ...]
+) -> dict[str, float]:
+    """
+    Fit the intercept and feature coefficients to minimize the relative
+    error, otherwise the largest books decide the fit and small books are
+    overestimated. A feature has negative coefficient is dropped and the
+    rest are fitted again.
+    """
+    names = ("",) + features
+    # inverse of the targets, scaled to keep the ridge term small
+    smallest = min((target for target in targets if target > 0), default=1.0)
+    weights = [smallest / target if target > 0 else 1.0 for target in targets]
+    while True:
+        coefficients = solve_normal_equations(samples, targets, names, weights)
+        negative = [name for name, value in coefficients.items() if value < 0]
+        if len(negative) == 0:
+            return coefficients
+        names = tuple(name for name in names if name not in negative)
+
+
+def solve_normal_equations(
+    samples: list[dict[str, Any]],
+    targets: list[float],
+    names: tuple[str, ...],
+    weights: list[float],
+) -> dict[str, float]:
+    """
+    Weighted least squares by Gaussian elimination, features are scaled to
+    keep the system well conditioned. "" is the intercept.
+    """
+    size = len(names)
+    scales = [
+        1.0 if name == "" else max(abs(sample[name]) for sample in samples) or 1.0
+        for name in names
+    ]
+    rows = [
+        [
+            weight * (1.0 if name == "" else sample[name] / scale)
+            for name, scale in zip(names, scales)
+        ]
+        for sample, weight in zip(samples, weights)
+    ]
+    matrix = [
+        [sum(row[i] * row[j] for row in rows) for j in range(size)]
+        + [
+            sum(
+                row[i] * target * weight
+                for row, target, weight in zip(rows, targets, weights)
+            )
+        ]
+        for i in range(size)
+    ]
+    # ridge term keeps the system solvable with fewer samples than features
+    for i in range(size):
+        matrix[i][i] += 1e-6
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda r: abs(matrix[r][column]))
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        for row_index in range(size):
+            if row_index != column:
+                factor = matrix[row_index][column] / matrix[column][column]
+                matrix[row_index] = [
+                    a - factor * b for a, b in zip(matrix[row_index], matrix[column])
+                ]
+    return {
+        name: matrix[index][size] / matrix[index][index] / scale
+        for index, (name, scale) in enumerate(zip(names, scales))
+    }
+
+
+def main(argv: list[str]) -> None:
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(prog="kpfgen estimate")
+    parser.add_argument("epub_path", type=Path, help="EPUB file")
+    parser.add_argument(
+        "--calibration",
+        type=Path,
+        metavar="JSON_PATH",
+        help="Fit the conversion cost model to benchmark results of the browser stages",
+    )
+    parser.add_argument(
+        "--stage",
+        default="create_kpf",
+        help="Benchmark stage to fit, default is create_kpf",
+    )
+    args = parser.parse_args(argv)
+
+    model = None
+    if args.calibration is not None:
+        with args.calibration.expanduser().open() as f:
+            model = fit_cost_model(json.load(f), args.stage)
+    json.dump(estimate_epub(args.epub_path.expanduser(), model), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,199 @@
+"""
+Report what takes space in a KPF or KDF file as JSON.
+
+$ kpfgen inspect book.kpf
+"""
+
+import sqlite3
+import zipfile
+from pathlib import Path
+from typing import Any
+
+KDF_MEMBER = "resources/book.kdf"
+RES_PREFIX = "resources/"
+
+
+def inspect_kpf(path: Path, top: int = 20) -> dict[str, Any]:
+    """
+    Return sizes of the KPF members, fragment bytes and counts grouped by
+    payload type and element type, the `top` largest fragments, resource
+    sizes and resources have the same content.
+
+    The KDF database is copied from the zip file in chunks to a temporary
+    file and read by SQLite from disk, resources are hashed in chunks, so
+    large files aren't loaded to memory. `path` can also be a KDF file, its
+    resources are in the "res" directory next to it.
+    """
+    import tempfile
+    from contextlib import closing
+
+    if not zipfile.is_zipfile(path):
+        with closing(connect_readonly(path)) as conn:
+            report = inspect_kdf(conn, top)
+        res_dir = path.parent
+        report["resources"] = inspect_resources(
+            {
+                res_path.relative_to(res_dir).as_posix(): res_path
+                for res_path in sorted((res_dir / "res").glob("*"))
+                if res_path.is_file()
+            }
+        )
+        return report
+
+    import shutil
+
+    with zipfile.ZipFile(path) as zf, tempfile.TemporaryDirectory() as tmpdir:
+        members = [
+            {
+                "name": info.filename,
+                "size": info.file_size,
+                "compressed_size": info.compress_size,
+            }
+            for info in zf.infolist()
+        ]
+        db_path = Path(tmpdir) / "book.kdf"
+        with zf.open(KDF_MEMBER) as src, db_path.open("wb") as dst:
+            shutil.copyfileobj(src, dst, 2**20)
+        with closing(connect_readonly(db_path)) as conn:
+            report = inspect_kdf(conn, top)
+        report["resources"] = inspect_resources(
+            {
+                info.filename.removeprefix(RES_PREFIX): info
+                for info in zf.infolist()
+                if info.filename.startswith(RES_PREFIX + "res/") and not info.is_dir()
+            },
+            zf,
+        )
+    report["kpf_bytes"] = path.stat().st_size
+    report["members"] = members
+    return report
+
+
+def connect_readonly(db_path: Path) -> sqlite3.Connection:
+    return sqlite3.connect(
+        f"{db_path.resolve().as_uri()}?mode=ro&immutable=1", uri=True
+    )
+
+
+def inspect_kdf(conn: sqlite3.Connection, top: int) -> dict[str, Any]:
+    """
+    Group fragments by payload type and element type in SQL, only fragment
+    ids and payload lengths are read.
+    """
+    types = [
+        {
+            "payload_type": payload_type,
+            "element_type": element_type,
+            "count": count,
+            "bytes": size,
+        }
+        for payload_type, element_type, count, size in conn.execute(
+            """
+            SELECT f.payload_type, p.value, count(*), sum(length(f.payload_value))
+            FROM fragments f LEFT JOIN fragment_properties p
+            ON p.id = f.id AND p.key = 'element_type'
+            GROUP BY 1, 2 ORDER BY 4 DESC
+            """
+        )
+    ]
+    largest = [
+        {
+            "id": fragment_id,
+            "payload_type": payload_type,
+            "element_type": element_type,
+            "bytes": size,
+        }
+        for fragment_id, payload_type, element_type, size in conn.execute(
+            """
+            SELECT f.id, f.payload_type, p.value, length(f.payload_value)
+            FROM fragments f LEFT JOIN fragment_properties p
+            ON p.id = f.id AND p.key = 'element_type'
+            ORDER BY 4 DESC LIMIT ?
+            """,
+            (top,),
+        )
+    ]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return {
+        "kdf_bytes": page_size * page_count,
+        "free_bytes": page_size * freelist_count,
+        "fragments": sum(row["count"] for row in types),
+        "fragment_bytes": sum(row["bytes"] or 0 for row in types),
+        "properties": conn.execute(
+            "SELECT count(*) FROM fragment_properties"
+        ).fetchone()[0],
+        "types": types,
+        "largest_fragments": largest,
+    }
+
+
+def inspect_resources(
+    resources: dict[str, zipfile.ZipInfo] | dict[str, Path],
+    zf: zipfile.ZipFile | None = None,
+) -> dict[str, Any]:
+    """
+    Hash resource files in chunks and group the files have the same hash.
+    """
+    import hashlib
+    from typing import IO
+
+    sizes: dict[str, int] = {}
+    by_hash: dict[str, list[str]] = {}
+    for name, resource in resources.items():
+        digest = hashlib.sha256()
+        f: IO[bytes]
+        if isinstance(resource, Path):
+            f = resource.open("rb")
+            sizes[name] = resource.stat().st_size
+        else:
+            assert zf is not None
+            f = zf.open(resource)
+            sizes[name] = resource.file_size
+        with f:
+            while chunk := f.read(2**20):
+                digest.update(chunk)
+        by_hash.setdefault(digest.hexdigest(), []).append(name)
+    duplicates = sorted(
+        (
+            (sizes[names[0]] * (len(names) - 1), digest, names)
+            for digest, names in by_hash.items()
+            if len(names) > 1
+        ),
+        reverse=True,
+    )
+    return {
+        "count": len(sizes),
+        "bytes": sum(sizes.values()),
+        "files": [
+            {"name": name, "bytes": size}
+            for name, size in sorted(sizes.items(), key=lambda item: -item[1])
+        ],
+        "duplicates": [
+            {"sha256": digest, "names": names, "wasted_bytes": wasted_bytes}
+            for wasted_bytes, digest, names in duplicates
+        ],
+    }
+
+
+def main(argv: list[str]) -> None:
+    import argparse
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(prog="kpfgen inspect")
+    parser.add_argument("path", type=Path, help="KPF or KDF file")
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of largest fragments to list"
+    )
+    parser.add_argument("-o", "--output", type=Path)
+    args = parser.parse_args(argv)
+
+    report = inspect_kpf(args.path.expanduser(), args.top)
+    if args.output is not None:
+        with args.output.open("w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
@@ -1,76 +1,393 @@
+import threading
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
 from amazon.ion.core import IonType
 from amazon.ion.simple_types import IonPyDict, IonPyList, IonPySymbol, IonPyText
+from amazon.ion.symbols import SymbolTable, SymbolTableCatalog, SymbolToken
 from lxml import etree
 from selenium.webdriver.common.by import By
 from selenium.webdriver.remote.webdriver import WebDriver
 from selenium.webdriver.remote.webelement import WebElement
 
+from .options import ConversionOptions
+from .profiling import Profiler
+
+# fragment ids reserved for each shard
+SHARD_ID_RANGE = 32**5
+# start a new content fragment after this many characters
+CONTENT_FRAGMENT_SIZE = 64 * 1024
+# style of the cover and other images
+IMAGE_STYLE = {
+    "font_size": {"value": 1.0, "unit": IonPySymbol.from_value(IonType.SYMBOL, "rem")},
+    "line_height": {"value": 1.0, "unit": IonPySymbol.from_value(IonType.SYMBOL, "lh")},
+}
+# fragments are always reachable, sections are reachable from the reading order
+GC_ROOT_ELEMENT_TYPES = (
+    "$ion_symbol_table",
+    "max_id",
+    "book_metadata",
+    "content_features",
+    "document_data",
+    "metadata",
+    "book_navigation",
+    "yj.section_pid_count_map",
+    "location_map",
+    "style",
+)
+# fragments created from all sections
+BOOK_FRAGMENT_IDS = (
+    "book_navigation",
+    "yj.section_pid_count_map",
+    "location_map",
+    "document_data",
+    "metadata",
+)
+# elements of `arguments[0]` have an id attribute and their ancestors below
+# it, parents are before children: [elements, parent indexes, [id, index]]
+ID_ELEMENTS_SCRIPT = """
+const body = arguments[0];
+const elements = [];
+const parents = [];
+const indexes = new Map();
+function index(element) {
+  if (element === body) {
+    return -1;
+  }
+  let elementIndex = indexes.get(element);
+  if (elementIndex === undefined) {
+    const parentIndex = index(element.parentElement);
+    elementIndex = elements.length;
+    indexes.set(element, elementIndex);
+    elements.push(element);
+    parents.push(parentIndex);
+  }
+  return elementIndex;
+}
+const ids = [];
+for (const element of body.querySelectorAll("[id]")) {
+  ids.push([element.id, index(element)]);
+}
+return [elements, parents, ids];
+"""
+# only the DOM and computed styles are used, disable everything else
+FIREFOX_PREFERENCES = {
+    "javascript.enabled": False,
+    "gfx.downloadable_fonts.enabled": False,
+    "image.animation_mode": "none",
+    "media.autoplay.default": 5,
+    "dom.ipc.processCount": 1,
+    "browser.cache.disk.enable": False,
+    "browser.sessionhistory.max_entries": 1,
+    "browser.sessionstore.max_tabs_undo": 0,
+    "browser.sessionstore.resume_from_crash": False,
+    "network.prefetch-next": False,
+    "network.dns.disablePrefetch": True,
+    "app.update.auto": False,
+    "app.normandy.enabled": False,
+    "extensions.update.enabled": False,
+    "browser.safebrowsing.malware.enabled": False,
+    "browser.safebrowsing.phishing.enabled": False,
+    "datareporting.healthreport.uploadEnabled": False,
+    "datareporting.policy.dataSubmissionEnabled": False,
+    "toolkit.telemetry.enabled": False,
+    "toolkit.telemetry.unified": False,
+    "toolkit.telemetry.archive.enabled": False,
+}
+
+
+# section id, [(structure id, structure length)]
+Section = tuple[str, list[tuple[str, int]]]
+
+
+@dataclass
+class SpineSections:
+    section_ids: list[str] = field(default_factory=list)
+    # spine item: {element id: (structure id, offset)}, "" is the start of the
+    # spine document
+    anchors: dict[str, dict[str, tuple[str, int]]] = field(default_factory=dict)
+    # section id: [(structure id, structure length)]
+    structure_ids: dict[str, list[tuple[str, int]]] = field(default_factory=dict)
+    # spine item path relative to the EPUB directory: section ids, a long
+    # spine document is split into sections
+    spine_items: dict[str, list[str]] = field(default_factory=dict)
+
+    def extend(self, other: "SpineSections") -> None:
+        self.section_ids.extend(other.section_ids)
+        self.anchors.update(other.anchors)
+        self.structure_ids.update(other.structure_ids)
+        self.spine_items.update(other.spine_items)
+
+    def add(
+        self,
+        spine_item: str,
+        sections: list[Section],
+        anchors: dict[str, tuple[str, int]],
+    ) -> None:
+        self.section_ids.extend(section_id for section_id, _ in sections)
+        self.add_structures(spine_item, sections, anchors)
+
+    def replace(
+        self,
+        spine_item: str,
+        sections: list[Section],
+        anchors: dict[str, tuple[str, int]],
+    ) -> None:
+        """
+        Replace the sections of a spine item and keep the spine order.
+        """
+        old_section_ids = self.spine_items[spine_item]
+        index = self.section_ids.index(old_section_ids[0])
+        self.section_ids[index : index + len(old_section_ids)] = [
+            section_id for section_id, _ in sections
+        ]
+        for old_section_id in old_section_ids:
+            self.structure_ids.pop(old_section_id, None)
+        self.add_structures(spine_item, sections, anchors)
+        self.structure_ids = {
+            s_id: self.structure_ids[s_id]
+            for s_id in self.section_ids
+            if s_id in self.structure_ids
+        }
 
-class KDF:
-    def __init__(self) -> None:
-        self.create_symbol_catalog()
-        self.fragment_id = 0
-        self.webdriver = init_webdriver()
+    def add_structures(
+        self,
+        spine_item: str,
+        sections: list[Section],
+        anchors: dict[str, tuple[str, int]],
+    ) -> None:
+        self.spine_items[spine_item] = [section_id for section_id, _ in sections]
+        self.anchors[spine_item] = anchors
+        for section_id, structure_ids in sections:
+            if len(structure_ids) > 0:
+                self.structure_ids[section_id] = structure_ids
+                anchors.setdefault("", (structure_ids[0][0], 0))
 
-    def create_symbol_catalog(self) -> None:
-        from amazon.ion.symbols import SymbolTableCatalog, shared_symbol_table
+    def resolve(self, base_item: str, href: str) -> tuple[str, int] | None:
+        """
+        Return structure id and offset of a link in the `base_item` file, or
+        `None` if it doesn't link to a spine document. Links to an element
+        id not in the index go to the start of the document.
+        """
+        link = split_link(base_item, href)
+        if link is None:
+            return None
+        anchors = self.anchors.get(link[0], {})
+        return anchors.get(link[1], anchors.get(""))
 
-        from .yj_symbols import YJ_CONVERSION_SYMBOLS, YJ_SYMBOLS
 
-        self.symbol_table = shared_symbol_table(
-            "YJ_symbols", 10, YJ_SYMBOLS + YJ_CONVERSION_SYMBOLS
-        )
-        self.catalog = SymbolTableCatalog()
-        self.catalog.register(self.symbol_table)
+@dataclass
+class Checkpoint:
+    """
+    State of an interrupted conversion, saved after the KDF database is
+    committed. Fragments written after the checkpoint are rolled back by
+    SQLite, so the next run continues from the last completed spine item.
+    """
 
-    def create_kdf(self, tmp_dir: Path, db_path: Path) -> None:
-        from .epub import get_epub_metadata
+    path: Path
+    # SHA-256 of the EPUB file, the checkpoint of another file is ignored
+    source_digest: str
+    # book metadata and cover section are written
+    started: bool = False
+    finished: bool = False
+    spine_items: int = 0
+    fragment_id: int = 0
+    sections: SpineSections = field(default_factory=SpineSections)
+
+    @classmethod
+    def load(cls, path: Path, source_digest: str) -> "Checkpoint":
+        import json
+
+        if not path.exists():
+            return cls(path, source_digest)
+        data = json.loads(path.read_text())
+        if data["source_digest"] != source_digest:
+            return cls(path, source_digest)
+        sections = data.pop("sections")
+        return cls(
+            path,
+            sections=SpineSections(
+                sections["section_ids"],
+                {
+                    spine_item: {
+                        element_id: (s_id, offset)
+                        for element_id, (s_id, offset) in anchors.items()
+                    }
+                    for spine_item, anchors in sections["anchors"].items()
+                },
+                {
+                    section_id: [(s_id, s_len) for s_id, s_len in spm_list]
+                    for section_id, spm_list in sections["structure_ids"].items()
+                },
+                sections["spine_items"],
+            ),
+            **data,
+        )
 
-        self.res_dir = db_path.parent / "res"
-        self.res_dir.mkdir(exist_ok=True)
-        db_path.unlink(True)
-        self.create_kdf_tables(db_path)
-        self.insert_ion_symbol_table()
-        self.epub_metadata = get_epub_metadata(tmp_dir)
-        cover_res_id = self.insert_cover_section()
-        self.insert_book_metadata(cover_res_id)
-        section_ids = self.process_spine_items()
-        self.create_document_data(section_ids)
-        self.webdriver.quit()
-        self.conn.commit()
-        self.conn.close()
+    def save(self) -> None:
+        import dataclasses
+        import json
+        import os
 
-    def create_kdf_tables(self, db_path: Path) -> None:
-        import sqlite3
+        data = dataclasses.asdict(self)
+        del data["path"]
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.path)
 
-        self.conn = sqlite3.connect(db_path)
-        self.conn.executescript(
-            """
-            CREATE TABLE capabilities(
-                key char(20), version smallint, primary key (key, version)
-            ) without rowid;
 
-            CREATE TABLE fragments(
-                id char(40), payload_type char(10), payload_value blob, primary key (id)
-            );
+class KDF:
+    def __init__(
+        self,
+        profiler: Profiler | None = None,
+        webdriver: WebDriver | None = None,
+        options: ConversionOptions | None = None,
+    ) -> None:
+        """
+        `webdriver` can be a `static_render.StaticDriver` to build the KDF
+        without Firefox, a new Firefox instance is started by default.
+        """
+        self.profiler = Profiler() if profiler is None else profiler
+        self.options = ConversionOptions() if options is None else options
+        self.create_symbol_catalog()
+        self.fragment_id = 0
+        self.driver = webdriver
+        # Firefox is started, recycled and closed by `KDF`, a driver passed in
+        # is owned by the caller
+        self.owns_driver = webdriver is None
+        self.loaded_pages = 0
+        # resource files created by the current spine item
+        self.new_resources: list[Path] = []
+        if webdriver is None and self.options.processes <= 1:
+            self.start_webdriver()
+        # window handle and URL of the page loading in background
+        self.prefetch_window = ""
+        self.prefetch_url = ""
+        self.checkpoint: Checkpoint | None = None
+        # `style_key()` of style properties: style fragment id
+        self.styles: dict[Any, str] = {}
+        # current content fragment of the `content_fragments` option
+        self.content_id = ""
+        self.content_texts: list[str] = []
+        self.content_size = 0
+        self.content_story_id = ""
+        # element of the current spine document: id of the structure created
+        # from it, to find the structures of elements have an id attribute
+        self.element_structures: dict[WebElement, str] = {}
+
+    @property
+    def webdriver(self) -> WebDriver:
+        if self.driver is None:
+            self.start_webdriver()
+        assert self.driver is not None
+        return self.driver
+
+    def start_webdriver(self) -> None:
+        with self.profiler.stage("init_webdriver"):
+            self.driver = init_webdriver(self.options)
+            self.driver.set_page_load_timeout(self.options.page_load_timeout)
+        count_webdriver_calls(self.driver, self)
+        self.loaded_pages = 0
+
+    def quit_webdriver(self) -> None:
+        if self.driver is not None and self.owns_driver:
+            self.driver.quit()
+            self.driver = None
+        self.prefetch_url = ""
+
+    def recycle_webdriver(self) -> None:
+        """
+        Restart Firefox after it loaded too many pages or uses too much
+        memory. Called between spine documents.
+        """
+        if self.driver is None or not self.owns_driver:
+            return
+        recycle_pages = self.options.recycle_pages
+        recycle_rss = self.options.recycle_rss
+        if (recycle_pages > 0 and self.loaded_pages >= recycle_pages) or (
+            recycle_rss > 0 and webdriver_rss(self.driver) >= recycle_rss * 1024 * 1024
+        ):
+            with self.profiler.stage("recycle_webdriver"):
+                self.profiler.count("webdriver_restarts")
+                self.quit_webdriver()
+                self.start_webdriver()
 
-            CREATE TABLE fragment_properties(
-                id char(40), key char(40), value char(40), primary key (id, key, value)
-            ) without rowid;
+    def create_symbol_catalog(self) -> None:
+        self.symbol_table, self.catalog, self.ion_header = yj_symbol_catalog()
 
-            CREATE TABLE gc_fragment_properties(
-                id varchar(40), key varchar(40), value varchar(40),
-                primary key (id, key, value)
-            ) without rowid;
+    def create_kdf(
+        self, tmp_dir: Path, db_path: Path, checkpoint: Checkpoint | None = None
+    ) -> None:
+        """
+        With `checkpoint`, commit the database and save the checkpoint after
+        each spine item, and continue from a started checkpoint.
+        """
+        from .epub import get_epub_metadata
 
-            CREATE TABLE gc_reachable(id varchar(40), primary key (id)) without rowid;
+        self.checkpoint = checkpoint
+        self.epub_dir = tmp_dir
+        self.res_dir = db_path.parent / "res"
+        self.res_dir.mkdir(exist_ok=True)
+        self.db_path = db_path
+        if checkpoint is not None and checkpoint.finished:
+            return
+        resume = checkpoint is not None and checkpoint.started
+        self.fragment_id = checkpoint.fragment_id if checkpoint and resume else 0
+        self.styles = {}
+        if resume:
+            self.styles = self.read_styles(db_path)
+        else:
+            db_path.unlink(True)
+        self.open_writer(db_path, resume)
+        try:
+            if not resume:
+                self.insert_ion_symbol_table()
+            with self.profiler.stage("epub_metadata"):
+                self.epub_metadata = get_epub_metadata(tmp_dir)
+            if not resume:
+                with self.profiler.stage("cover"):
+                    cover_res_id = self.insert_cover_section()
+                self.insert_book_metadata(cover_res_id)
+                self.save_checkpoint()
+            self.sections = self.process_spine_items()
+            self.create_book_fragments(self.sections)
+        except BaseException:
+            # stop the pipeline threads, fragments after the last checkpoint
+            # aren't committed
+            self.writer.abort()
+            raise
+        self.close_kdf()
+        if checkpoint is not None:
+            checkpoint.finished = True
+            checkpoint.save()
+
+    def open_writer(self, db_path: Path, resume: bool = False) -> None:
+        from .writer import KDFWriter, PipelinedKDFWriter
+
+        if self.options.pipeline_workers > 0:
+            self.writer: KDFWriter = PipelinedKDFWriter(
+                db_path,
+                self.encode_blob,
+                self.profiler,
+                self.options.pipeline_workers,
+                self.options.pipeline_queue_size,
+                resume,
+            )
+        else:
+            self.writer = KDFWriter(db_path, self.encode_blob, self.profiler, resume)
 
-            INSERT INTO capabilities VALUES('db.schema', 1);
-            """
-        )
+    def save_checkpoint(self) -> None:
+        if self.checkpoint is None:
+            return
+        with self.profiler.stage("checkpoint"):
+            self.writer.commit()
+            self.checkpoint.started = True
+            self.checkpoint.fragment_id = self.fragment_id
+            self.checkpoint.save()
 
     def insert_ion_symbol_table(self) -> None:
         from amazon.ion import simpleion
@@ -95,23 +412,30 @@ class KDF:
         )
 
     def insert_blob_fragment(
-        self, fragment_id: str, ion: str | IonPyDict, annotation: str = ""
+        self, fragment_id: str, ion: str | IonPyDict | IonPyList, annotation: str = ""
     ) -> None:
+        self.writer.insert_blob_fragment(fragment_id, ion, annotation)
+
+    def decode_blob(self, blob: bytes) -> Any:
+        from amazon.ion import simpleion
+
+        return simpleion.loads(self.ion_header + blob[4:], catalog=self.catalog)
+
+    def encode_blob(self, ion: str | IonPyDict | IonPyList, annotation: str) -> bytes:
         from amazon.ion import simpleion
         from amazon.ion.core import IonType
 
-        if isinstance(ion, str):
-            value = simpleion.loads(ion, catalog=self.catalog)
-            value = IonPyDict.from_value(IonType.STRUCT, value, (annotation,))
-        else:
-            value = ion
-        self.insert_fragment(
-            fragment_id,
-            "blob",
-            remove_ion_table(
+        with self.profiler.stage("ion_encoding"):
+            if isinstance(ion, str):
+                value = simpleion.loads(ion, catalog=self.catalog)
+                value = IonPyDict.from_value(IonType.STRUCT, value, (annotation,))
+            else:
+                value = ion
+            blob = remove_ion_table(
                 simpleion.dumps(value, binary=True, imports=(self.symbol_table,))
-            ),
-        )
+            )
+        self.profiler.add_fragment(value.ion_annotations[0], len(blob))
+        return blob
 
     def insert_book_metadata(self, cover_res_id: str) -> None:
         import random
@@ -157,6 +481,7 @@ class KDF:
             ("book_metadata",),
         )
         self.insert_blob_fragment("book_metadata", ion)
+        self.insert_fragment_property("book_metadata", "element_type", "book_metadata")
         self.insert_content_features()
 
     def insert_content_features(self) -> None:
@@ -201,7 +526,9 @@ class KDF:
   ]
 }}"""
         self.insert_blob_fragment(section_id, section_text, "section")
-        self.insert_fragment_property(section_id, "element_type", "section")
+        self.insert_fragment_properties(
+            [(section_id, "element_type", "section"), (section_id, "child", story_id)]
+        )
 
         struct_id = self.create_fragment_id("i")
         storyline_text = f"""{{
@@ -220,13 +547,7 @@ class KDF:
         )
 
         res_id = self.insert_image_resource(self.epub_metadata.cover_path)
-        style_id = self.create_fragment_id("s")
-        style_text = f"""{{
-  font_size: {{value: 1.0e0, unit: rem}},
-  line_height: {{value: 1.0e0, unit: lh}},
-  style_name: kfx_id::"{style_id}"
-}}"""
-        self.insert_blob_fragment(style_id, style_text, "style")
+        style_id = self.get_style_id(IMAGE_STYLE)
 
         struct_text = f"""{{
   kfx_id: kfx_id::"{struct_id}",
@@ -248,6 +569,44 @@ class KDF:
         self.insert_section_auxiliary_data(section_id)
         return res_id
 
+    def get_style_id(self, properties: dict[str, Any]) -> str:
+        """
+        Return id of the style fragment has `properties`, the fragment is
+        created the first time, structures with the same style share it.
+        """
+        key = style_key(properties)
+        style_id = self.styles.get(key)
+        if style_id is not None:
+            return style_id
+        style_id = self.create_fragment_id("s")
+        self.styles[key] = style_id
+        ion = IonPyDict.from_value(
+            IonType.STRUCT,
+            {**properties, "style_name": kfx_id_ion(style_id)},
+            ("style",),
+        )
+        self.insert_blob_fragment(style_id, ion)
+        self.insert_fragment_property(style_id, "element_type", "style")
+        return style_id
+
+    def read_styles(self, db_path: Path) -> dict[Any, str]:
+        import sqlite3
+
+        styles = {}
+        conn = sqlite3.connect(db_path)
+        try:
+            for style_id, blob in conn.execute(
+                "SELECT id, payload_value FROM fragments WHERE id IN "
+                "(SELECT id FROM fragment_properties "
+                "WHERE key = 'element_type' AND value = 'style')"
+            ):
+                properties = dict(self.decode_blob(blob))
+                del properties["style_name"]
+                styles[style_key(properties)] = style_id
+        finally:
+            conn.close()
+        return styles
+
     def create_fragment_id(self, prefix: str) -> str:
         fragment_id_str = prefix + int_to_base32(self.fragment_id)
         self.fragment_id += 1
@@ -258,6 +617,9 @@ class KDF:
 
         from PIL import Image
 
+        res_id = self.create_fragment_id("e")
+        res_loc_id = self.create_fragment_id("rsrc")
+        res_path = self.res_dir / res_loc_id
         with Image.open(image_path) as im:
             im_width, im_height = im.size
             if im.mode == "RGBA":  # convert to JPEG, can't display PNG
@@ -265,11 +627,12 @@ class KDF:
                 new_im = Image.new("RGBA", im.size, (255, 255, 255))
                 new_im.paste(im, mask=im.split()[3])
                 new_im = new_im.convert("RGB")
-                image_path = image_path.with_suffix(".jpg")
-                new_im.save(image_path)
+                # save to the resource directory, don't change the EPUB files
+                new_im.save(res_path, "JPEG")
+            else:
+                shutil.copy(image_path, res_path)
+        self.new_resources.append(res_path)
 
-        res_id = self.create_fragment_id("e")
-        res_loc_id = self.create_fragment_id("rsrc")
         res_text = f"""{{
   format: jpg,
   location: "{res_loc_id}",
@@ -285,26 +648,21 @@ class KDF:
                 (res_loc_id, "element_type", "bcRawMedia"),
             ]
         )
-        shutil.copy(image_path, self.res_dir / res_loc_id)
+        self.profiler.count("images")
+        self.profiler.count("image_bytes", res_path.stat().st_size)
         self.insert_fragment(res_loc_id, "path", f"{self.res_dir.name}/{res_loc_id}")
         return res_id
 
     def insert_fragment(
         self, fragment_id: str, payload_type: str, payload_value: str | bytes
     ) -> None:
-        self.conn.execute(
-            "INSERT INTO fragments VALUES(?, ?, ?)",
-            (fragment_id, payload_type, payload_value),
-        )
+        self.writer.insert_fragment(fragment_id, payload_type, payload_value)
 
     def insert_fragment_property(self, fragment_id: str, key: str, value: str) -> None:
-        self.conn.execute(
-            "INSERT INTO fragment_properties VALUES(?, ?, ?)",
-            (fragment_id, key, value),
-        )
+        self.writer.insert_fragment_properties([(fragment_id, key, value)])
 
     def insert_fragment_properties(self, data) -> None:
-        self.conn.executemany("INSERT INTO fragment_properties VALUES(?, ?, ?)", data)
+        self.writer.insert_fragment_properties(data)
 
     def insert_section_auxiliary_data(self, section_id: str) -> None:
         ad_id = section_id + "-ad"
@@ -320,23 +678,453 @@ class KDF:
             ]
         )
 
-    def process_spine_items(self) -> list[str]:
-        first_structure_ids: dict[str, str] = {}
-        section_ids = ["c0"]
-        all_structure_ids = {}
-        for xml_path in self.epub_metadata.spine_paths:
-            section_id, structure_ids = self.create_section(xml_path)
-            section_ids.append(section_id)
-            if len(structure_ids) > 0:
-                first_structure_ids[xml_path.name] = structure_ids[0][0]
-                all_structure_ids[section_id] = structure_ids
-        self.create_book_navigation(first_structure_ids)
-        self.create_section_pid_count_map(all_structure_ids)
-        self.create_location_map(all_structure_ids)
-        return section_ids
-
-    def create_section(self, xml_path: Path) -> tuple[str, list[tuple[str, int]]]:
-        section_id = self.create_fragment_id("c")
+    def process_spine_items(self) -> SpineSections:
+        spine_paths = self.epub_metadata.spine_paths
+        # shards can't be resumed, render sequentially with checkpoints
+        if (
+            self.options.processes > 1
+            and len(spine_paths) > 1
+            and self.checkpoint is None
+        ):
+            sections = self.render_shards(spine_paths)
+        else:
+            sections = self.render_spine_items(spine_paths)
+        return sections
+
+    def create_book_fragments(self, sections: SpineSections) -> None:
+        """
+        Create fragments depend on all sections: navigation, position maps and
+        reading order.
+        """
+        with self.profiler.stage("navigation"):
+            self.create_book_navigation(sections)
+        with self.profiler.stage("position_maps"):
+            self.create_section_pid_count_map(sections.structure_ids)
+            self.create_location_map(sections.structure_ids)
+        # the cover section is created first
+        cover_section_ids = [] if self.epub_metadata.cover_path is None else ["c0"]
+        section_ids = cover_section_ids + sections.section_ids
+        self.create_document_data(section_ids)
+        with self.profiler.stage("gc"):
+            self.collect_garbage(section_ids)
+
+    def collect_garbage(self, section_ids: list[str]) -> None:
+        root_ids = section_ids + [f"{section_id}-spm" for section_id in section_ids]
+        res_paths = self.writer.collect_garbage(
+            root_ids, GC_ROOT_ELEMENT_TYPES, self.options.prune_fragments
+        )
+        for res_path in res_paths:
+            (self.res_dir.parent / res_path).unlink(True)
+        self.profiler.count("pruned_resources", len(res_paths))
+
+    def load_kdf(self, epub_dir: Path, db_path: Path) -> None:
+        """
+        Read sections and the fragment id counter of a KDF database created
+        from an earlier version of the EPUB with the same spine, then
+        `update_spine_items()` can replace sections. The counter is larger
+        than the ids of fragments and structures in section position maps.
+        """
+        import sqlite3
+
+        from .epub import get_epub_metadata
+
+        self.epub_dir = epub_dir
+        self.res_dir = db_path.parent / "res"
+        self.res_dir.mkdir(exist_ok=True)
+        self.db_path = db_path
+        self.epub_metadata = get_epub_metadata(epub_dir)
+        self.styles = self.read_styles(db_path)
+        spine_items = [
+            path.relative_to(epub_dir).as_posix()
+            for path in self.epub_metadata.spine_paths
+        ]
+        conn = sqlite3.connect(db_path)
+        try:
+            fragment_ids = [row[0] for row in conn.execute("SELECT id FROM fragments")]
+
+            def load_fragment(fragment_id: str) -> Any:
+                row = conn.execute(
+                    "SELECT payload_value FROM fragments WHERE id = ?", (fragment_id,)
+                ).fetchone()
+                if row is None:
+                    raise ValueError(f"KDF file doesn't have {fragment_id} fragment")
+                return self.decode_blob(row[0])
+
+            document_data = load_fragment("document_data")
+            section_ids = list(map(str, document_data["reading_orders"][0]["sections"]))
+            if self.epub_metadata.cover_path is not None:
+                section_ids = section_ids[1:]
+            # sections split from a spine document are named "{section id}-{n}"
+            spine_item_section_ids: list[list[str]] = []
+            for section_id in section_ids:
+                if len(spine_item_section_ids) > 0 and section_id.startswith(
+                    spine_item_section_ids[-1][0] + "-"
+                ):
+                    spine_item_section_ids[-1].append(section_id)
+                else:
+                    spine_item_section_ids.append([section_id])
+            if len(spine_item_section_ids) != len(spine_items):
+                raise ValueError("EPUB spine doesn't match the KDF file")
+            section_lens = {
+                str(entry["section_name"]): entry["length"]
+                for entry in load_fragment("yj.section_pid_count_map")["contains"]
+            }
+            sections = SpineSections()
+            for spine_item, item_section_ids in zip(
+                spine_items, spine_item_section_ids
+            ):
+                spine_item_sections = []
+                for section_id in item_section_ids:
+                    contains = load_fragment(f"{section_id}-spm")["contains"]
+                    # inline structures of the `content_fragments` option
+                    # aren't fragments, their ids are only in position maps
+                    fragment_ids.extend(str(s_id) for _, s_id in contains)
+                    # skip the section structure
+                    contains = contains[1:]
+                    end = section_lens.get(section_id, 0) + 1
+                    next_locations = [location for location, _ in contains[1:]]
+                    structure_ids = [
+                        (str(structure_id), next_location - location)
+                        for (location, structure_id), next_location in zip(
+                            contains, next_locations + [end]
+                        )
+                    ]
+                    spine_item_sections.append((section_id, structure_ids))
+                sections.add(spine_item, spine_item_sections, {})
+            if "book_navigation" in fragment_ids:
+                self.load_nav_anchors(sections, load_fragment("book_navigation"))
+        finally:
+            conn.close()
+        self.sections = sections
+        self.fragment_id = next_fragment_id(fragment_ids)
+
+    def load_nav_anchors(self, sections: SpineSections, navigation: Any) -> None:
+        """
+        Element ids aren't saved in the KDF file, add the anchors used by the
+        navigation entries created from the same navigation document.
+        """
+        from .epub import NAMESPACES
+
+        if self.epub_metadata.toc is None:
+            return
+        toc_item = self.epub_metadata.toc.relative_to(self.epub_dir).as_posix()
+        toc_root = etree.parse(self.epub_metadata.toc)
+        hrefs = [
+            href
+            for ol_tag in toc_root.iterfind(".//xml:nav/xml:ol", NAMESPACES)
+            for href in nav_hrefs(ol_tag)
+            if sections.resolve(toc_item, href) is not None
+        ]
+        targets = [
+            target
+            for nav_container in navigation[0]["nav_containers"]
+            for target in nav_targets(nav_container["entries"])
+        ]
+        if len(hrefs) != len(targets):
+            return
+        for href, target in zip(hrefs, targets):
+            link = split_link(toc_item, href)
+            if link is not None and link[1] != "":
+                sections.anchors[link[0]].setdefault(link[1], target)
+
+    def update_spine_items(self, spine_paths: list[Path]) -> None:
+        """
+        Render changed spine documents again and replace their sections in
+        the KDF database created by the last `create_kdf()` call. Fragments
+        of other sections are unchanged, the fragments depend on all sections
+        are created again.
+        """
+        self.open_writer(self.db_path, resume=True)
+        try:
+            self.writer.delete_fragments(BOOK_FRAGMENT_IDS)
+            for xml_path in spine_paths:
+                spine_item = xml_path.relative_to(self.epub_dir).as_posix()
+                old_section_ids = self.sections.spine_items[spine_item]
+                with self.profiler.stage("delete_section"):
+                    for res_path in self.writer.delete_subtree(
+                        old_section_ids
+                        + [f"{section_id}-spm" for section_id in old_section_ids]
+                    ):
+                        (self.res_dir.parent / res_path).unlink(True)
+                with (
+                    self.profiler.stage("spine_items"),
+                    self.profiler.spine_item(spine_item),
+                ):
+                    spine_item_sections, anchors = self.render_spine_item(
+                        xml_path, None, spine_item
+                    )
+                self.sections.replace(spine_item, spine_item_sections, anchors)
+            self.create_book_fragments(self.sections)
+        except BaseException:
+            self.writer.abort()
+            raise
+        self.close_kdf()
+
+    def close_kdf(self) -> None:
+        from .writer import optimize_kdf
+
+        self.writer.close()
+        if self.options.optimize_kdf:
+            with self.profiler.stage("optimize_kdf"):
+                self.profiler.count(
+                    "unoptimized_kdf_bytes", self.db_path.stat().st_size
+                )
+                optimize_kdf(self.db_path)
+        self.profiler.count("kdf_bytes", self.db_path.stat().st_size)
+        if self.options.verify_kdf:
+            from .verify import verify_kdf
+
+            with self.profiler.stage("verify_kdf"):
+                problems = verify_kdf(self.db_path)
+            if len(problems) > 0:
+                raise ValueError("Invalid KDF file: " + "; ".join(problems[:10]))
+
+    def render_spine_items(self, spine_paths: list[Path]) -> SpineSections:
+        checkpoint = self.checkpoint
+        sections = SpineSections() if checkpoint is None else checkpoint.sections
+        first_index = 0 if checkpoint is None else checkpoint.spine_items
+        if first_index > 0:
+            self.profiler.count("resumed_spine_items", first_index)
+        for index, xml_path in enumerate(spine_paths):
+            if index < first_index:
+                continue
+            spine_item = xml_path.relative_to(self.epub_dir).as_posix()
+            next_path = spine_paths[index + 1] if index + 1 < len(spine_paths) else None
+            with (
+                self.profiler.stage("spine_items"),
+                self.profiler.spine_item(spine_item),
+            ):
+                spine_item_sections, anchors = self.render_spine_item(
+                    xml_path, next_path, spine_item
+                )
+            sections.add(spine_item, spine_item_sections, anchors)
+            if checkpoint is not None:
+                checkpoint.spine_items = index + 1
+                self.save_checkpoint()
+        return sections
+
+    def render_spine_item(
+        self, xml_path: Path, next_path: Path | None, spine_item: str
+    ) -> tuple[list[Section], dict[str, tuple[str, int]]]:
+        """
+        Create sections of a spine document. If the browser fails or the
+        document takes longer than the chapter timeout, restart the browser
+        and try again once, then extract the text with lxml.
+
+        Fragments and resource files of the failed attempt are removed and
+        the fragment ids are reused.
+        """
+        import logging
+
+        from selenium.common.exceptions import WebDriverException
+
+        from .static_render import StaticDriver
+
+        first_fragment_id = self.fragment_id
+        styles = self.styles.copy()
+        for attempt in range(2):
+            self.writer.savepoint()
+            self.new_resources = []
+            watchdog = Watchdog(self.webdriver, self.options.chapter_timeout)
+            try:
+                with watchdog:
+                    rendered = self.create_section(xml_path, next_path)
+                self.writer.release()
+                return rendered
+            except Exception as e:
+                if not (watchdog.expired or isinstance(e, WebDriverException)):
+                    raise
+                self.writer.rollback()
+                for path in self.new_resources:
+                    path.unlink(True)
+                self.fragment_id = first_fragment_id
+                self.styles = styles.copy()
+                # texts of the failed attempt's content fragment
+                self.reset_content_fragment()
+                action = "retry" if attempt == 0 else "fallback"
+                incident = {
+                    "spine_item": spine_item,
+                    "error": "timeout" if watchdog.expired else str(e).strip(),
+                    "action": action,
+                }
+                logging.warning("Rendering %s failed: %s", spine_item, incident)
+                self.profiler.add_incident(incident)
+                self.quit_webdriver()
+
+        driver, owns_driver = self.driver, self.owns_driver
+        self.driver, self.owns_driver = StaticDriver(), False  # type: ignore[assignment]
+        try:
+            return self.create_section(xml_path)
+        finally:
+            self.driver, self.owns_driver = driver, owns_driver
+
+    def render_shards(self, spine_paths: list[Path]) -> SpineSections:
+        """
+        Render contiguous parts of the spine in worker processes, each has its
+        own browser and writes to its own SQLite database with a reserved
+        fragment id range. Then merge the databases in spine order.
+        """
+        import dataclasses
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        shards = split_spine(spine_paths, self.options.processes)
+        tasks = [
+            ShardTask(
+                db_path=self.db_path.with_name(f"shard{index}.kdf"),
+                first_fragment_id=(index + 1) * SHARD_ID_RANGE,
+                spine_paths=shard,
+                epub_dir=self.epub_dir,
+                res_dir=self.res_dir,
+                epub_metadata=self.epub_metadata,
+                options=dataclasses.replace(self.options, processes=1),
+            )
+            for index, shard in enumerate(shards)
+        ]
+        sections = SpineSections()
+        with (
+            self.profiler.stage("shards"),
+            ProcessPoolExecutor(
+                len(tasks), mp_context=multiprocessing.get_context("spawn")
+            ) as executor,
+        ):
+            for task, (shard_sections, report) in zip(
+                tasks, executor.map(render_shard, tasks)
+            ):
+                sections.extend(shard_sections)
+                self.profiler.merge(report)
+                with self.profiler.stage("merge_shards"):
+                    self.intern_shard_styles(task.db_path)
+                    self.writer.merge(task.db_path)
+                    # the pipelined writer only queues the merge
+                    self.writer.commit()
+                task.db_path.unlink()
+        return sections
+
+    def intern_shard_styles(self, db_path: Path) -> None:
+        """
+        Every shard creates its own style fragments. Remove the styles of the
+        shard database the book already has and replace their references with
+        the book's style ids, so each distinct style is written once. Only
+        blobs contain the removed ids are decoded.
+        """
+        import sqlite3
+        from contextlib import closing
+
+        from amazon.ion import simpleion
+
+        renamed = {}
+        for key, style_id in self.read_styles(db_path).items():
+            book_style_id = self.styles.setdefault(key, style_id)
+            if book_style_id != style_id:
+                renamed[style_id] = book_style_id
+        if len(renamed) == 0:
+            return
+        with closing(sqlite3.connect(db_path)) as conn, conn:
+            old_ids = [(style_id,) for style_id in renamed]
+            conn.executemany("DELETE FROM fragments WHERE id = ?", old_ids)
+            conn.executemany("DELETE FROM fragment_properties WHERE id = ?", old_ids)
+            conn.executemany(
+                "UPDATE fragment_properties SET value = ? "
+                "WHERE key = 'child' AND value = ?",
+                [(new_id, old_id) for old_id, new_id in renamed.items()],
+            )
+            condition = " OR ".join(["instr(payload_value, ?) > 0"] * len(renamed))
+            rows = conn.execute(
+                "SELECT id, payload_value FROM fragments WHERE payload_type = 'blob' "
+                f"AND id != '$ion_symbol_table' AND ({condition})",
+                [style_id.encode() for style_id in renamed],
+            ).fetchall()
+            for fragment_id, blob in rows:
+                value = self.decode_blob(blob)
+                if replace_kfx_ids(value, renamed):
+                    blob = remove_ion_table(
+                        simpleion.dumps(
+                            value, binary=True, imports=(self.symbol_table,)
+                        )
+                    )
+                    conn.execute(
+                        "UPDATE fragments SET payload_value = ? WHERE id = ?",
+                        (blob, fragment_id),
+                    )
+
+    def create_section(
+        self, xml_path: Path, next_path: Path | None = None
+    ) -> tuple[list[Section], dict[str, tuple[str, int]]]:
+        """
+        Create sections of a spine document, and return them with the
+        structure id and offset of the elements have an id attribute. With
+        the `split_section_size` option, a new section starts at the next
+        block of the body after the current section has that many positions.
+        """
+        first_section_id = self.create_fragment_id("c")
+        section_id = first_section_id
+        section_struct_id, storyline_id = self.start_section(section_id)
+        with self.profiler.stage("page_load"):
+            self.load_page(xml_path, next_path)
+            # drivers passed in don't block images
+            if self.options.block_images and self.owns_driver:
+                self.declare_image_sizes()
+        body = self.webdriver.find_element(By.TAG_NAME, "body")
+        self.element_structures = {}
+        split_size = self.options.split_section_size
+        sections: list[Section] = []
+        contents: list[str | IonPyDict] = []
+        spm_list: list[tuple[str, int]] = []
+        section_size = 0
+        for child in body.find_elements(By.XPATH, "*"):
+            if split_size > 0 and section_size >= split_size and len(contents) > 0:
+                self.finish_section(
+                    section_id, section_struct_id, storyline_id, contents, spm_list
+                )
+                sections.append((section_id, spm_list))
+                section_id = f"{first_section_id}-{len(sections)}"
+                section_struct_id, storyline_id = self.start_section(section_id)
+                contents, spm_list, section_size = [], [], 0
+            structures = len(spm_list)
+            content = self.process_tag(child, storyline_id, spm_list)
+            if content is not None:
+                contents.append(content)
+            section_size += sum(s_len for _, s_len in spm_list[structures:])
+        self.finish_section(
+            section_id, section_struct_id, storyline_id, contents, spm_list
+        )
+        sections.append((section_id, spm_list))
+        if len(sections) > 1:
+            self.profiler.count("split_sections", len(sections) - 1)
+        return sections, self.find_anchors(body)
+
+    def find_anchors(self, body: WebElement) -> dict[str, tuple[str, int]]:
+        """
+        Map id attributes of the document to the innermost structure created
+        from the element or its ancestors. Offset is 0, an anchor in a text
+        structure points to the start of the text. The elements and their
+        ancestors are read in one WebDriver call, structures are found
+        locally.
+        """
+        from .static_render import StaticElement, id_elements
+
+        if isinstance(body, StaticElement):
+            elements, parents, ids = id_elements(body)
+        else:
+            elements, parents, ids = self.webdriver.execute_script(
+                ID_ELEMENTS_SCRIPT, body
+            )
+        anchors: dict[str, tuple[str, int]] = {}
+        for element_id, index in ids:
+            while element_id not in anchors and index >= 0:
+                structure_id = self.element_structures.get(elements[index])
+                if structure_id is not None:
+                    anchors[element_id] = (structure_id, 0)
+                index = parents[index]
+        self.element_structures = {}
+        return anchors
+
+    def start_section(self, section_id: str) -> tuple[str, str]:
+        """
+        Create section fragment, return ids of its page template structure
+        and storyline.
+        """
         section_struct_id = self.create_fragment_id("i")
         storyline_id = self.create_fragment_id("l")
         section_ion = f"""{{
@@ -351,15 +1139,37 @@ class KDF:
 }}"""
         self.insert_blob_fragment(section_id, section_ion, "section")
         self.insert_section_auxiliary_data(section_id)
-        spm_list = self.create_storyline(xml_path, storyline_id)
+        self.reset_content_fragment()
+        self.content_story_id = storyline_id
+        return section_struct_id, storyline_id
+
+    def finish_section(
+        self,
+        section_id: str,
+        section_struct_id: str,
+        storyline_id: str,
+        contents: list[str | IonPyDict],
+        spm_list: list[tuple[str, int]],
+    ) -> None:
+        self.insert_content_fragment()
+        storyline_ion = IonPyDict.from_value(
+            IonType.STRUCT,
+            {
+                "story_name": kfx_id_ion(storyline_id),
+                "content_list": content_list_ion(contents),
+            },
+            ("storyline",),
+        )
+        self.insert_blob_fragment(storyline_id, storyline_ion)
         self.insert_fragment_properties(
             [
+                (storyline_id, "element_type", "storyline"),
+                (storyline_id, "child", storyline_id),
                 (section_id, "element_type", "section"),
                 (section_id, "child", storyline_id),
             ]
         )
         self.create_section_spm(section_id, section_struct_id, spm_list)
-        return section_id, spm_list
 
     def create_section_spm(
         self, section_id: str, section_struct_id: str, spm_list: list[tuple[str, int]]
@@ -380,61 +1190,136 @@ class KDF:
         self.insert_blob_fragment(spm_id, spm_ion, "section_position_id_map")
         self.insert_fragment_property(spm_id, "element_type", "section_position_id_map")
 
-    def create_storyline(self, xml_path: Path, story_id: str) -> list[tuple[str, int]]:
-        self.webdriver.get("file://" + str(xml_path))
-        body = self.webdriver.find_element(By.TAG_NAME, "body")
-        content_ids = []
-        spm_list: list[tuple[str, int]] = []
-        for child in body.find_elements(By.XPATH, "*"):
-            content_id = self.process_tag(child, story_id, spm_list)
-            if content_id is not None:
-                content_ids.append(content_id)
-        content_str = ", ".join(f'kfx_id::"{content_id}"' for content_id in content_ids)
-        storyline_ion = f"""{{
-  story_name: kfx_id::"{story_id}",
-  content_list: [{content_str}]
-}}"""
-        self.insert_blob_fragment(story_id, storyline_ion, "storyline")
-        self.insert_fragment_properties(
-            [(story_id, "element_type", "storyline"), (story_id, "child", story_id)]
+    def load_page(self, xml_path: Path, next_path: Path | None) -> None:
+        """
+        Load `xml_path` in the current window. With the prefetch option, also
+        start loading `next_path` in another window of the same browser, it
+        will be loaded while `xml_path` is being processed.
+        """
+        self.recycle_webdriver()
+        self.loaded_pages += 1
+        url = "file://" + str(xml_path)
+        # drivers passed in don't use the "none" page load strategy
+        if not self.options.prefetch or not self.owns_driver:
+            self.webdriver.get(url)
+            return
+        if self.prefetch_url == url:
+            self.webdriver.switch_to.window(self.prefetch_window)
+        else:
+            start_page_load(self.webdriver, url)
+        self.prefetch_url = ""
+        wait_for_page_load(self.webdriver, url, self.options.page_load_timeout)
+        if next_path is None:
+            return
+        page_window = self.webdriver.current_window_handle
+        other_windows = [h for h in self.webdriver.window_handles if h != page_window]
+        if len(other_windows) == 0:
+            self.webdriver.switch_to.new_window("tab")
+        else:
+            self.webdriver.switch_to.window(other_windows[0])
+        self.prefetch_window = self.webdriver.current_window_handle
+        # page load strategy is "none", `get()` doesn't wait
+        start_page_load(self.webdriver, "file://" + str(next_path))
+        self.prefetch_url = "file://" + str(next_path)
+        self.webdriver.switch_to.window(page_window)
+
+    def declare_image_sizes(self) -> None:
+        """
+        Firefox doesn't load images with the `block_images` option, an image
+        without width and height attributes has no size and isn't displayed.
+        Set the missing attributes to the size in the image file's header,
+        then the page has the same layout as with images loaded.
+        """
+        from urllib.parse import unquote, urlsplit
+
+        from PIL import Image
+
+        sources = self.webdriver.execute_script(
+            "return Array.from(document.images, img => "
+            "img.hasAttribute('width') && img.hasAttribute('height') ? '' : img.src)"
+        )
+        sizes = []
+        for index, src in enumerate(sources):
+            url = urlsplit(src)
+            if url.scheme != "file":
+                continue
+            try:
+                with Image.open(unquote(url.path)) as im:
+                    width, height = im.size
+            except OSError:
+                continue
+            if width > 0 and height > 0:
+                sizes.append((index, width, height))
+        if len(sizes) == 0:
+            return
+        # keep the aspect ratio if one attribute is a number of pixels
+        self.webdriver.execute_script(
+            """
+            for (const [index, width, height] of arguments[0]) {
+              const img = document.images[index];
+              const widthAttr = Number(img.getAttribute("width") ?? NaN);
+              const heightAttr = Number(img.getAttribute("height") ?? NaN);
+              if (!img.hasAttribute("width")) {
+                img.setAttribute("width", isNaN(heightAttr) ?
+                  width : Math.round(heightAttr * width / height));
+              }
+              if (!img.hasAttribute("height")) {
+                img.setAttribute("height", isNaN(widthAttr) ?
+                  height : Math.round(widthAttr * height / width));
+              }
+            }
+            """,
+            sizes,
         )
-        return spm_list
 
     def process_tag(
         self, tag: WebElement, parent_id: str, spm_list: list[tuple[str, int]]
-    ) -> str | None:
+    ) -> str | IonPyDict | None:
+        """
+        Return id of the created structure fragment, or the structure if
+        it's inlined.
+        """
         if not is_tag_displayed(tag):
             return None
-        if tag.tag_name == "figure":
-            return self.create_container_structure(tag, parent_id, spm_list)
-        elif tag.tag_name == "img":
-            return self.process_img_tag(tag, parent_id)
+        content: str | IonPyDict | None = None
+        tag_name = tag.tag_name
+        if tag_name == "figure":
+            content = self.create_container_structure(tag, parent_id, spm_list)
+        elif tag_name == "img":
+            content = self.process_img_tag(tag, parent_id)
         elif is_block_tag(tag):
             if not contain_block_tag(tag):
                 if len(tag.text) > 0:
-                    return self.create_text_structure(tag, parent_id, spm_list)
+                    content = self.create_text_structure(tag, parent_id, spm_list)
             else:
-                return self.create_container_structure(tag, parent_id, spm_list)
-        return None
+                content = self.create_container_structure(tag, parent_id, spm_list)
+        if isinstance(content, str):
+            self.element_structures[tag] = content
+        elif content is not None:
+            self.element_structures[tag] = str(content["kfx_id"])
+        return content
 
     def create_container_structure(
         self, tag: WebElement, parent_id: str, spm_list: list[tuple[str, int]]
     ) -> str:
         structure_id = self.create_fragment_id("i")
         spm_list.append((structure_id, 1))
-        content_ids = []
+        contents = []
         for child in tag.find_elements(By.XPATH, "*"):
-            content_id = self.process_tag(child, structure_id, spm_list)
-            if content_id is not None:
-                content_ids.append(content_id)
-
-        content_str = ", ".join(f'kfx_id::"{content_id}"' for content_id in content_ids)
-        structure_ion = f"""{{
-  kfx_id: kfx_id::"{structure_id}",
-  type: container,
-  content_list: [{content_str}],
-}}"""
-        self.insert_blob_fragment(structure_id, structure_ion, "structure")
+            content = self.process_tag(child, structure_id, spm_list)
+            if content is not None:
+                contents.append(content)
+
+        structure_ion = IonPyDict.from_value(
+            IonType.STRUCT,
+            {
+                "kfx_id": kfx_id_ion(structure_id),
+                "type": IonPySymbol.from_value(IonType.SYMBOL, "container"),
+                "content_list": content_list_ion(contents),
+            },
+            ("structure",),
+        )
+        self.insert_blob_fragment(structure_id, structure_ion)
         self.insert_fragment_properties(
             [
                 (parent_id, "child", structure_id),
@@ -445,8 +1330,21 @@ class KDF:
 
     def create_text_structure(
         self, tag: WebElement, parent_id: str, spm_list: list[tuple[str, int]]
-    ) -> str:
+    ) -> str | IonPyDict:
         structure_id = self.create_fragment_id("i")
+        if self.options.content_fragments:
+            # inline structure references the text in a content fragment
+            text = tag.text
+            ion = IonPyDict.from_value(
+                IonType.STRUCT,
+                {
+                    "kfx_id": kfx_id_ion(structure_id),
+                    "type": IonPySymbol.from_value(IonType.SYMBOL, "text"),
+                    "content": self.add_content_text(text),
+                },
+            )
+            spm_list.append((structure_id, len(text)))
+            return ion
         ion = IonPyDict.from_value(
             IonType.STRUCT,
             {
@@ -468,6 +1366,42 @@ class KDF:
         spm_list.append((structure_id, len(tag.text)))
         return structure_id
 
+    def add_content_text(self, text: str) -> dict[str, Any]:
+        """
+        Add text to the current content fragment and return its reference.
+        """
+        if self.content_id == "" or self.content_size >= CONTENT_FRAGMENT_SIZE:
+            self.insert_content_fragment()
+            self.content_id = self.create_fragment_id("t")
+        self.content_texts.append(text)
+        self.content_size += len(text)
+        return {
+            "name": kfx_id_ion(self.content_id),
+            "index": len(self.content_texts) - 1,
+        }
+
+    def insert_content_fragment(self) -> None:
+        if self.content_id == "":
+            return
+        ion = IonPyDict.from_value(
+            IonType.STRUCT,
+            {"name": kfx_id_ion(self.content_id), "content_list": self.content_texts},
+            ("content",),
+        )
+        self.insert_blob_fragment(self.content_id, ion)
+        self.insert_fragment_properties(
+            [
+                (self.content_story_id, "child", self.content_id),
+                (self.content_id, "element_type", "content"),
+            ]
+        )
+        self.reset_content_fragment()
+
+    def reset_content_fragment(self) -> None:
+        self.content_id = ""
+        self.content_texts = []
+        self.content_size = 0
+
     def create_document_data(self, section_ids: list[str]) -> None:
         section_ion_str = ",".join(
             f'kfx_id::"{section_id}"' for section_id in section_ids
@@ -498,15 +1432,16 @@ class KDF:
         self.insert_blob_fragment("metadata", metadata_ion, "metadata")
         self.insert_fragment_property("metadata", "element_type", "metadata")
 
-    def create_book_navigation(self, structure_ids: dict[str, str]) -> None:
+    def create_book_navigation(self, sections: SpineSections) -> None:
         from .epub import NAMESPACES
 
         if self.epub_metadata.toc is None:
             return None
         toc_root = etree.parse(self.epub_metadata.toc)
+        toc_item = self.epub_metadata.toc.relative_to(self.epub_dir).as_posix()
         nav_containers = []
         for ol_tag in toc_root.iterfind(".//xml:nav/xml:ol", NAMESPACES):
-            nav_entries = self.create_nav_entries(ol_tag, structure_ids)
+            nav_entries = self.create_nav_entries(ol_tag, sections, toc_item)
             nav_container_id = self.create_fragment_id("n")
             nav_container_ion = IonPyDict.from_value(
                 IonType.STRUCT,
@@ -539,7 +1474,7 @@ class KDF:
         )
 
     def create_nav_entries(
-        self, ol_tag: etree._Element, structure_ids: dict[str, str]
+        self, ol_tag: etree._Element, sections: SpineSections, toc_item: str
     ) -> list[IonPyDict]:
         from .epub import NAMESPACES
 
@@ -551,17 +1486,18 @@ class KDF:
             nested_entries: list[IonPyDict] = []
             nested_ol_tag = li_tag.find("xml:ol", NAMESPACES)
             if nested_ol_tag is not None:
-                nested_entries = self.create_nav_entries(nested_ol_tag, structure_ids)
+                nested_entries = self.create_nav_entries(
+                    nested_ol_tag, sections, toc_item
+                )
             label = a_tag.xpath("string()")
-            href = Path(a_tag.get("href", "")).name
-            if href in structure_ids:
+            target = sections.resolve(toc_item, a_tag.get("href", ""))
+            if target is not None:
+                structure_id, offset = target
                 nav_unit_data: dict[str, Any] = {
                     "representation": {"label": label},
                     "target_position": {
-                        "id": IonPyText.from_value(
-                            IonType.STRING, structure_ids[href], ("kfx_id",)
-                        ),
-                        "offset": 0,
+                        "id": kfx_id_ion(structure_id),
+                        "offset": offset,
                     },
                 }
                 if len(nested_entries) > 0:
@@ -629,16 +1565,16 @@ class KDF:
 
     def process_img_tag(self, img_tag: WebElement, parent_id: str) -> str | None:
         structure_id = self.create_fragment_id("i")
-        # style_id = self.create_fragment_id("s")
         img_src = img_tag.get_attribute("src")
         if img_src is None:
             return None
+        style_id = self.get_style_id(IMAGE_STYLE)
         resource_name = self.insert_image_resource(
             Path(img_src.removeprefix("file://"))
         )
         img_ion_data = {
             "kfx_id": IonPyText.from_value(IonType.STRING, structure_id, ("kfx_id",)),
-            # "style": IonPyText.from_value(IonType.STRING, style_id, ("kfx_id",)),
+            "style": kfx_id_ion(style_id),
             "type": IonPySymbol.from_value(IonType.SYMBOL, "image"),
             "resource_name": resource_name,
         }
@@ -657,6 +1593,188 @@ class KDF:
         return structure_id
 
 
+@dataclass
+class ShardTask:
+    db_path: Path
+    first_fragment_id: int
+    spine_paths: list[Path]
+    epub_dir: Path
+    res_dir: Path
+    epub_metadata: Any
+    options: ConversionOptions
+
+
+def render_shard(
+    task: ShardTask, webdriver: WebDriver | None = None
+) -> tuple[SpineSections, dict[str, Any]]:
+    """
+    Render a shard in a worker process, `webdriver` is for rendering without
+    Firefox in tests.
+    """
+    profiler = Profiler()
+    kdf = KDF(profiler, webdriver, task.options)
+    kdf.fragment_id = task.first_fragment_id
+    kdf.epub_dir = task.epub_dir
+    kdf.res_dir = task.res_dir
+    kdf.epub_metadata = task.epub_metadata
+    kdf.open_writer(task.db_path)
+    try:
+        sections = kdf.render_spine_items(task.spine_paths)
+    except BaseException:
+        kdf.writer.abort()
+        raise
+    finally:
+        kdf.quit_webdriver()
+    kdf.writer.close()
+    return sections, profiler.report()
+
+
+def split_spine(spine_paths: list[Path], parts: int) -> list[list[Path]]:
+    """
+    Split spine to contiguous parts have similar file sizes.
+    """
+    sizes = [path.stat().st_size for path in spine_paths]
+    part_size = sum(sizes) / min(parts, len(spine_paths))
+    shards: list[list[Path]] = [[]]
+    current_size = 0
+    for path, size in zip(spine_paths, sizes):
+        if current_size >= part_size and len(shards) < parts:
+            shards.append([])
+            current_size = 0
+        shards[-1].append(path)
+        current_size += size
+    return shards
+
+
+def style_key(value: Any) -> Any:
+    """
+    Return a hashable canonical form of style properties, property order
+    doesn't matter.
+    """
+    from collections.abc import Mapping
+
+    if isinstance(value, Mapping):
+        return tuple(sorted((str(key), style_key(v)) for key, v in value.items()))
+    if isinstance(value, SymbolToken):
+        return ("symbol", value.text)
+    if isinstance(value, (list, tuple)):
+        return ("list", tuple(style_key(v) for v in value))
+    for value_type in (bool, int, float, str):
+        if isinstance(value, value_type):
+            return (value_type.__name__, value)
+    return (type(value).__name__, str(value))
+
+
+def replace_kfx_ids(value: Any, kfx_ids: dict[str, str]) -> bool:
+    """
+    Replace `kfx_id` annotated strings of a decoded Ion value in place,
+    return `True` if any is replaced.
+    """
+    from collections.abc import MutableMapping
+
+    replaced = False
+    stack = [value]
+    while len(stack) > 0:
+        container = stack.pop()
+        if isinstance(container, MutableMapping):
+            items = list(container.items())
+        elif isinstance(container, list):
+            items = list(enumerate(container))
+        else:
+            continue
+        for key, item in items:
+            if (
+                isinstance(item, IonPyText)
+                and str(item) in kfx_ids
+                and any(a.text == "kfx_id" for a in item.ion_annotations)
+            ):
+                container[key] = kfx_id_ion(kfx_ids[str(item)])
+                replaced = True
+            else:
+                stack.append(item)
+    return replaced
+
+
+def split_link(base_item: str, href: str) -> tuple[str, str] | None:
+    """
+    Return path relative to the EPUB directory and element id of a link in
+    the `base_item` file, `None` for external links.
+    """
+    import posixpath
+    from urllib.parse import unquote, urlsplit
+
+    url = urlsplit(href)
+    if url.scheme != "" or url.netloc != "":
+        return None
+    path = base_item
+    if url.path != "":
+        path = posixpath.normpath(
+            posixpath.join(posixpath.dirname(base_item), unquote(url.path))
+        )
+    return path, unquote(url.fragment)
+
+
+def nav_hrefs(ol_tag: etree._Element) -> Iterator[str]:
+    """
+    Yield links of navigation entries in the order `KDF.create_nav_entries()`
+    visits them, nested entries follow their parent.
+    """
+    from .epub import NAMESPACES
+
+    for li_tag in ol_tag.iterfind("xml:li", NAMESPACES):
+        a_tag = li_tag.find("xml:a", NAMESPACES)
+        if a_tag is None:
+            continue
+        yield a_tag.get("href", "")
+        nested_ol_tag = li_tag.find("xml:ol", NAMESPACES)
+        if nested_ol_tag is not None:
+            yield from nav_hrefs(nested_ol_tag)
+
+
+def nav_targets(entries: list[Any]) -> Iterator[tuple[str, int]]:
+    for entry in entries:
+        target = entry["target_position"]
+        yield str(target["id"]), target["offset"]
+        yield from nav_targets(entry.get("entries", []))
+
+
+def kfx_id_ion(fragment_id: str) -> IonPyText:
+    return IonPyText.from_value(IonType.STRING, fragment_id, ("kfx_id",))
+
+
+def content_list_ion(contents: list[str | IonPyDict]) -> list[IonPyText | IonPyDict]:
+    """
+    Reference fragments by id, inlined structures are added as they are.
+    """
+    return [
+        kfx_id_ion(content) if isinstance(content, str) else content
+        for content in contents
+    ]
+
+
+def yj_symbol_catalog() -> tuple[SymbolTable, SymbolTableCatalog, bytes]:
+    """
+    Return the YJ shared symbol table, a catalog has it and the Ion header
+    removed from fragment blobs by `remove_ion_table()`.
+    """
+    from amazon.ion import simpleion
+    from amazon.ion.symbols import shared_symbol_table
+
+    from .yj_symbols import YJ_CONVERSION_SYMBOLS, YJ_SYMBOLS
+
+    symbol_table = shared_symbol_table(
+        "YJ_symbols", 10, YJ_SYMBOLS + YJ_CONVERSION_SYMBOLS
+    )
+    catalog = SymbolTableCatalog()
+    catalog.register(symbol_table)
+    ion_header = simpleion.dumps(
+        IonPyDict.from_value(IonType.STRUCT, {"kfx_id": ""}, ("structure",)),
+        binary=True,
+        imports=(symbol_table,),
+    )[:36]
+    return symbol_table, catalog, ion_header
+
+
 def remove_ion_table(binary: bytes) -> bytes:
     """
     Remove the extra import structure added by the "imports" arguments
@@ -665,11 +1783,14 @@ def remove_ion_table(binary: bytes) -> bytes:
     return b"\xe0\x01\x00\xea" + binary[36:]
 
 
+# no "I", "L", "O", "Q"
+BASE32_SYMBOLS = "0123456789ABCDEFGHJKMNPRSTUVWXYZ"
+
+
 def int_to_base32(num: int) -> str:
     if num == 0:
         return "0"
-    # no "I", "L", "O", "Q"
-    symbols = "0123456789ABCDEFGHJKMNPRSTUVWXYZ"
+    symbols = BASE32_SYMBOLS
     digits = []
     while num > 0:
         digits.append(symbols[num % 32])
@@ -678,18 +1799,164 @@ def int_to_base32(num: int) -> str:
     return "".join(digits)
 
 
-def init_webdriver() -> WebDriver:
+def base32_to_int(digits: str) -> int:
+    num = 0
+    for digit in digits:
+        num = num * 32 + BASE32_SYMBOLS.index(digit)
+    return num
+
+
+def next_fragment_id(fragment_ids: list[str]) -> int:
+    """
+    Return a fragment id counter larger than the counters of `fragment_ids`
+    created by `KDF.create_fragment_id()`.
+    """
+    import re
+
+    pattern = re.compile(f"(?:rsrc|[a-z])([{BASE32_SYMBOLS}]+)")
+    counters = [
+        base32_to_int(match.group(1))
+        for fragment_id in fragment_ids
+        if (match := pattern.fullmatch(fragment_id)) is not None
+    ]
+    return max(counters, default=-1) + 1
+
+
+def init_webdriver(conversion_options: ConversionOptions) -> WebDriver:
     from selenium import webdriver
     from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 
     options = webdriver.FirefoxOptions()
     firefox_profile = FirefoxProfile()
-    firefox_profile.set_preference("javascript.enabled", False)
+    for key, value in FIREFOX_PREFERENCES.items():
+        firefox_profile.set_preference(key, value)
+    if conversion_options.block_images:
+        # only `src` and `alt` are used, `KDF.declare_image_sizes()` sizes
+        # images don't declare their size
+        firefox_profile.set_preference("permissions.default.image", 2)
+    if not conversion_options.memory_cache:
+        firefox_profile.set_preference("browser.cache.memory.enable", False)
     options.profile = firefox_profile
     options.add_argument("-headless")
+    if conversion_options.prefetch:
+        # `KDF.load_page()` waits for the page
+        options.page_load_strategy = "none"
     return webdriver.Firefox(options=options)
 
 
+def webdriver_rss(driver: WebDriver) -> int:
+    """
+    Return resident memory in bytes of the Firefox process and its child
+    processes, or 0 if unknown. Only supports Linux.
+    """
+    pid = driver.capabilities.get("moz:processID")
+    if pid is None:
+        return 0
+    rss = 0
+    pids = [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        proc_path = Path(f"/proc/{pid}")
+        try:
+            for line in (proc_path / "status").read_text().splitlines():
+                if line.startswith("VmRSS:"):
+                    rss += int(line.split()[1]) * 1024
+                    break
+            for children_path in proc_path.glob("task/*/children"):
+                pids.extend(int(p) for p in children_path.read_text().split())
+        except OSError:
+            continue
+    return rss
+
+
+def count_webdriver_calls(driver: WebDriver, kdf: KDF) -> None:
+    # every driver and element command goes through `WebDriver.execute`,
+    # use the current profiler of a reused `KDF`
+    execute = driver.execute
+
+    def counted_execute(*args, **kwargs):
+        kdf.profiler.count("webdriver_calls")
+        with kdf.profiler.stage("webdriver"):
+            return execute(*args, **kwargs)
+
+    driver.execute = counted_execute  # type: ignore[method-assign]
+
+
+class Watchdog:
+    """
+    Kill the browser if the `with` block runs longer than `timeout` seconds,
+    the pending WebDriver call then fails.
+    """
+
+    def __init__(self, driver: WebDriver | None, timeout: float) -> None:
+        self.driver = driver
+        self.timeout = timeout
+        self.expired = False
+        self.timer: threading.Timer | None = None
+
+    def __enter__(self) -> "Watchdog":
+        if self.timeout > 0 and self.driver is not None:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def expire(self) -> None:
+        self.expired = True
+        if self.driver is not None:
+            kill_webdriver(self.driver)
+
+
+def kill_webdriver(driver: WebDriver) -> None:
+    import os
+    import signal
+
+    pid = driver.capabilities.get("moz:processID")
+    if pid is not None:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    service = getattr(driver, "service", None)
+    if service is not None and service.process is not None:
+        service.process.kill()
+
+
+def start_page_load(driver: WebDriver, url: str) -> None:
+    # mark the current document, it may still be the window's document after
+    # `get()` returns
+    driver.execute_script("document.kpfgenPreviousPage = true")
+    driver.get(url)
+
+
+def wait_for_page_load(driver: WebDriver, url: str, timeout: float) -> None:
+    """
+    Wait until the window has a new document of `url` and it's loaded.
+    `get()` returns before the navigation commits with the "none" page load
+    strategy, the old document or "about:blank" can be complete before that.
+    """
+    from urllib.parse import unquote
+
+    from selenium.webdriver.support.wait import WebDriverWait
+
+    def page_loaded(driver: WebDriver) -> bool:
+        document_url, ready_state, previous_page = driver.execute_script(
+            "return [document.URL, document.readyState, "
+            "document.kpfgenPreviousPage === true]"
+        )
+        return (
+            unquote(document_url) == unquote(url)
+            and ready_state == "complete"
+            and not previous_page
+        )
+
+    WebDriverWait(driver, timeout, poll_frequency=0.05).until(page_loaded)
+
+
 def contain_block_tag(tag: WebElement) -> bool:
     for child in tag.find_elements(By.XPATH, "*"):
         if is_block_tag(child):
@@ -1,43 +1,401 @@
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, cast
+
+from .options import ConversionOptions
+from .profiling import Profiler
+
+if TYPE_CHECKING:
+    from .kdf import KDF
+
+# subdirectory of the `work_dir` option kpfgen creates and removes, and the
+# file marks it
+WORK_DIR_NAME = ".kpfgen"
+WORK_DIR_MARKER = "kpfgen-work-dir"
 
 
 def main() -> None:
     import argparse
     import logging
-    from sys import exit
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("epub_path", type=Path)
+    parser = argparse.ArgumentParser(
+        epilog=f"subcommands: {', '.join(SUBCOMMANDS)}, run `kpfgen COMMAND -h`"
+    )
+    parser.add_argument(
+        "epub_path", type=Path, help="EPUB file or unpacked EPUB directory"
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="JSON_PATH",
+        help="Write per-stage timings and counters to a JSON file",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        metavar="DIR",
+        help="Keep extracted files and the KDF database in DIR and save a "
+        "checkpoint after each spine document",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted conversion from the checkpoint in --work-dir",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Rebuild the KPF file when files of the EPUB directory change",
+    )
+    add_conversion_arguments(parser)
     args = parser.parse_args()
+    if args.resume and args.work_dir is None:
+        parser.error("--resume requires --work-dir")
     epub_path = args.epub_path.expanduser()
     if not epub_path.exists():
         logging.error("EPUB file path doesn't exist")
-        exit(1)
-    create_kpf(epub_path)
+        sys.exit(1)
+    options = conversion_options(args)
+    if args.work_dir is not None:
+        options.work_dir = args.work_dir.expanduser()
+        options.resume = args.resume
+    if args.watch:
+        from .watch import watch
+
+        if not epub_path.is_dir():
+            parser.error("--watch requires an unpacked EPUB directory")
+        watch(epub_path, options)
+        return
+    profiler = Profiler()
+    create_kpf(epub_path, profiler, options)
+    if args.profile is not None:
+        profiler.write_json(args.profile.expanduser())
+
+
+def serve(argv: list[str]) -> None:
+    from .server import main
+
+    main(argv)
+
+
+def inspect(argv: list[str]) -> None:
+    from .inspection import main
+
+    main(argv)
+
+
+def verify(argv: list[str]) -> None:
+    from .verify import main
+
+    main(argv)
+
+
+def estimate(argv: list[str]) -> None:
+    from .estimate import main
+
+    main(argv)
+
+
+SUBCOMMANDS = {
+    "serve": serve,
+    "inspect": inspect,
+    "verify": verify,
+    "estimate": estimate,
+}
 
 
-def create_kpf(epub_path: Path) -> None:
+def add_conversion_arguments(parser) -> None:
+    parser.add_argument(
+        "--pipeline",
+        type=int,
+        default=0,
+        metavar="WORKERS",
+        help="Encode fragments in WORKERS threads while rendering pages",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Load the next spine document while processing the current one",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Render parts of the spine in multiple processes",
+    )
+    parser.add_argument(
+        "--block-images",
+        action="store_true",
+        help="Don't load images in Firefox, images without size attributes are "
+        "sized from their file headers",
+    )
+    parser.add_argument(
+        "--recycle-pages",
+        type=int,
+        default=0,
+        metavar="PAGES",
+        help="Restart Firefox after loading PAGES spine documents",
+    )
+    parser.add_argument(
+        "--recycle-rss",
+        type=int,
+        default=0,
+        metavar="MIB",
+        help="Restart Firefox when it uses more than MIB memory",
+    )
+    parser.add_argument(
+        "--page-load-timeout",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help="Maximum time to load a spine document",
+    )
+    parser.add_argument(
+        "--chapter-timeout",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Restart Firefox and retry a spine document takes longer than this, "
+        "then extract its text without Firefox",
+    )
+    parser.add_argument(
+        "--split-sections",
+        type=int,
+        default=0,
+        metavar="CHARS",
+        help="Split spine documents into sections of about CHARS characters "
+        "at block boundaries",
+    )
+    parser.add_argument(
+        "--content-fragments",
+        action="store_true",
+        help="Pack text of each section into shared content fragments",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete fragments and resources not reachable from the book",
+    )
+    parser.add_argument(
+        "--optimize-kdf",
+        action="store_true",
+        help="Index, analyze and vacuum the KDF database",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check references and position maps of the KDF database",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        default=6,
+        choices=range(10),
+        metavar="LEVEL",
+        help="Compress KPF file members with zlib LEVEL 0-9, 0 stores them",
+    )
+    parser.add_argument(
+        "--max-extract-size",
+        type=int,
+        default=4096,
+        metavar="MIB",
+        help="Reject EPUB files extract to more than MIB, 0 disables the limit",
+    )
+    parser.add_argument(
+        "--max-epub-members",
+        type=int,
+        default=100000,
+        metavar="FILES",
+        help="Reject EPUB files have more than FILES files, 0 disables the limit",
+    )
+
+
+def conversion_options(args) -> ConversionOptions:
+    return ConversionOptions(
+        pipeline_workers=args.pipeline,
+        prefetch=args.prefetch,
+        processes=args.processes,
+        block_images=args.block_images,
+        recycle_pages=args.recycle_pages,
+        recycle_rss=args.recycle_rss,
+        page_load_timeout=args.page_load_timeout,
+        chapter_timeout=args.chapter_timeout,
+        split_section_size=args.split_sections,
+        content_fragments=args.content_fragments,
+        prune_fragments=args.prune,
+        optimize_kdf=args.optimize_kdf,
+        verify_kdf=args.verify,
+        compression_level=args.compression_level,
+        max_extract_size=args.max_extract_size,
+        max_epub_members=args.max_epub_members,
+    )
+
+
+def create_kpf(
+    epub_path: Path,
+    profiler: Profiler | None = None,
+    options: ConversionOptions | None = None,
+    kdf: "KDF | None" = None,
+) -> Path:
+    """
+    Create KPF file next to the EPUB file or unpacked EPUB directory. Pass
+    `kdf` to reuse its browser, then `options` is ignored and the browser
+    isn't closed.
+    """
+    if profiler is None:
+        profiler = Profiler()
+    kpf_path = epub_path.with_suffix(".kpf")
+    try:
+        with kpf_path.open("wb") as dest:
+            if epub_path.is_dir():
+                convert(epub_path, dest, options, profiler, kdf)
+            else:
+                with epub_path.open("rb") as source:
+                    convert(source, dest, options, profiler, kdf)
+    except BaseException:
+        kpf_path.unlink(True)
+        raise
+    profiler.count("kpf_bytes", kpf_path.stat().st_size)
+    return kpf_path
+
+
+def convert(
+    source: bytes | BinaryIO | Path,
+    dest: BinaryIO,
+    options: ConversionOptions | None = None,
+    profiler: Profiler | None = None,
+    kdf: "KDF | None" = None,
+) -> None:
+    """
+    Convert EPUB bytes, file object or unpacked EPUB directory to KPF and
+    write it to `dest`.
+
+    Only the extracted EPUB files, which the browser needs, and the KDF
+    database are written to a temporary directory. `source` is read as zip
+    file and copied to the KPF file without writing it to disk again, `dest`
+    doesn't need to be seekable. A directory is read in place and packed
+    into the KPF file as "book.epub".
+
+    With the `work_dir` option, the files are written to its `WORK_DIR_NAME`
+    subdirectory instead, which is removed after the conversion succeeded.
+    """
     import shutil
     import tempfile
+    from io import BytesIO
 
-    from .epub import extract_epub
     from .kdf import KDF
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmp_path = Path(tmpdir)
-        kpf_dir = tmp_path / epub_path.stem
-        kpf_dir.mkdir()
-        resources_dir = kpf_dir / "resources"
-        resources_dir.mkdir()
-        shutil.copyfile(epub_path, kpf_dir / "book.epub")
-        extract_epub(epub_path, tmp_path)
-        create_kcb(kpf_dir)
-        kdf = KDF()
-        kdf.create_kdf(tmp_path, resources_dir / "book.kdf")
-        create_manifest_file(resources_dir)
-        shutil.make_archive(str(epub_path.with_suffix("")), "zip", kpf_dir)
-        kpf_path = epub_path.with_suffix(".zip")
-        kpf_path.rename(kpf_path.with_suffix(".kpf"))
+    if profiler is None:
+        profiler = Profiler()
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    elif not isinstance(source, Path) and not source.seekable():
+        spooled_source = tempfile.SpooledTemporaryFile(2**26)
+        shutil.copyfileobj(source, spooled_source)
+        source = cast(BinaryIO, spooled_source)
+    reuse_kdf = kdf is not None
+    if kdf is None:
+        kdf = KDF(profiler, options=options)
+    else:
+        kdf.profiler = profiler
+    work_dir = kdf.options.work_dir
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            convert_in_dir(source, dest, Path(tmpdir), kdf, reuse_kdf)
+        return
+    state_dir = open_work_dir(work_dir, source)
+    convert_in_dir(source, dest, state_dir, kdf, reuse_kdf)
+    shutil.rmtree(state_dir)
+
+
+def open_work_dir(work_dir: Path, source: BinaryIO | Path) -> Path:
+    """
+    Create the subdirectory of `work_dir` kpfgen keeps its files in and
+    return it, files of `work_dir` outside of it are never removed. An
+    existing subdirectory without the marker file isn't used, neither is one
+    contains the EPUB directory.
+    """
+    state_dir = work_dir / WORK_DIR_NAME
+    if isinstance(source, Path) and source.resolve().is_relative_to(
+        state_dir.resolve()
+    ):
+        raise ValueError(f"EPUB directory {source} is in work directory {state_dir}")
+    marker_path = state_dir / WORK_DIR_MARKER
+    if state_dir.exists() and not marker_path.is_file():
+        raise ValueError(f"{state_dir} isn't created by kpfgen")
+    state_dir.mkdir(parents=True, exist_ok=True)
+    marker_path.touch()
+    return state_dir
+
+
+def convert_in_dir(
+    source: BinaryIO | Path, dest: BinaryIO, tmp_path: Path, kdf: "KDF", reuse_kdf: bool
+) -> None:
+    import shutil
+
+    from .archive import write_kpf_archive
+    from .epub import extract_epub
+    from .kdf import Checkpoint
+
+    profiler = kdf.profiler
+    epub_dir = source if isinstance(source, Path) else tmp_path / "epub"
+    kpf_dir = tmp_path / "kpf"
+    resources_dir = kpf_dir / "resources"
+    checkpoint = None
+    if kdf.options.work_dir is not None:
+        checkpoint_path = tmp_path / "checkpoint.json"
+        if not kdf.options.resume:
+            checkpoint_path.unlink(True)
+        checkpoint = Checkpoint.load(checkpoint_path, source_digest(source))
+    if checkpoint is None or not checkpoint.started:
+        shutil.rmtree(kpf_dir, ignore_errors=True)
+        resources_dir.mkdir(parents=True)
+        if not isinstance(source, Path):
+            shutil.rmtree(epub_dir, ignore_errors=True)
+            with profiler.stage("extract_epub"):
+                extract_epub(
+                    source,
+                    epub_dir,
+                    kdf.options.max_extract_size * 1024 * 1024,
+                    kdf.options.max_epub_members,
+                )
+    else:
+        profiler.count("resumed_conversions")
+    create_kcb(kpf_dir)
+    try:
+        with profiler.stage("create_kdf"):
+            kdf.create_kdf(epub_dir, resources_dir / "book.kdf", checkpoint)
+    finally:
+        if not reuse_kdf:
+            kdf.quit_webdriver()
+    create_manifest_file(resources_dir)
+    with profiler.stage("write_kpf"):
+        write_kpf_archive(dest, source, kpf_dir, kdf.options.compression_level)
+
+
+def source_digest(source: BinaryIO | Path) -> str:
+    """
+    Hash EPUB file content, or file names, sizes and modification times of
+    an EPUB directory.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    if isinstance(source, Path):
+        for path in sorted(p for p in source.rglob("*") if p.is_file()):
+            stat = path.stat()
+            name = path.relative_to(source).as_posix()
+            digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+        return digest.hexdigest()
+    source.seek(0)
+    while chunk := source.read(2**20):
+        digest.update(chunk)
+    source.seek(0)
+    return digest.hexdigest()
 
 
 def create_kcb(kpf_dir: Path) -> None:
@@ -0,0 +1,59 @@
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass
+class ConversionOptions:
+    # encode Ion fragments in this many threads and write them to SQLite in
+    # another thread, 0 disables the pipeline
+    pipeline_workers: int = 0
+    # maximum number of fragments waiting to be encoded or written
+    pipeline_queue_size: int = 256
+    # load the next spine document in a second browser window while the
+    # current one is being processed
+    prefetch: bool = False
+    # render parts of the spine in this many processes, each has a browser
+    processes: int = 1
+    # block images in the browser, images without width and height attributes
+    # are sized from their file headers
+    block_images: bool = False
+    # restart the browser after it loaded this many pages, 0 disables it
+    recycle_pages: int = 0
+    # restart the browser when it uses more memory (MiB) than this, 0 disables it
+    recycle_rss: int = 0
+    # seconds to wait for a spine document to load
+    page_load_timeout: float = 300
+    # seconds a spine document can take before the browser is restarted,
+    # 0 disables it
+    chapter_timeout: float = 0
+    # start a new section at the next block of a spine document's body after
+    # the section has this many positions (characters), 0 disables it
+    split_section_size: int = 0
+    # pack text of each section into content fragments, text structures are
+    # inlined and reference the text by index
+    content_fragments: bool = False
+    # delete fragments and resource files not reachable from the book's root
+    # fragments
+    prune_fragments: bool = False
+    # index the KDF database, choose its page size, then run ANALYZE and
+    # VACUUM after it's created
+    optimize_kdf: bool = False
+    # check references and position maps of the KDF database after it's
+    # created, raise `ValueError` if it's broken
+    verify_kdf: bool = False
+    # zlib level of the KPF file members, files are compressed in parallel and
+    # already compressed files are stored, 0 stores every file
+    compression_level: int = 6
+    # cache loaded stylesheets and images in the browser's memory, the watch
+    # mode disables it to load changed files
+    memory_cache: bool = True
+    # limits of the extracted EPUB files (MiB) and the number of files in the
+    # EPUB, 0 disables them
+    max_extract_size: int = 4096
+    max_epub_members: int = 100000
+    # keep the extracted EPUB and the KDF database in the ".kpfgen"
+    # subdirectory of this directory and save a checkpoint after each spine
+    # document
+    work_dir: Path | None = None
+    # continue from the checkpoint in `work_dir`
+    resume: bool = False
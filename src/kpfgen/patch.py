@@ -0,0 +1,134 @@
+"""
+Replace sections of changed spine documents in an existing KPF or KDF file
+instead of converting the whole book again.
+"""
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .options import ConversionOptions
+from .profiling import Profiler
+
+if TYPE_CHECKING:
+    from .kdf import KDF
+
+
+def patch_kdf(
+    db_path: Path,
+    epub_dir: Path,
+    spine_items: list[str],
+    options: ConversionOptions | None = None,
+    profiler: Profiler | None = None,
+    kdf: "KDF | None" = None,
+) -> None:
+    """
+    Render `spine_items`, paths relative to `epub_dir`, again and replace
+    their sections in the KDF database. The spine must have the same
+    documents as the EPUB the database was created from. Resource files are
+    in the "res" directory next to the database.
+
+    Pass `kdf` to reuse its browser, then `options` is ignored and the
+    browser isn't closed.
+    """
+    from .kdf import KDF
+
+    if profiler is None:
+        profiler = Profiler()
+    reuse_kdf = kdf is not None
+    if kdf is None:
+        kdf = KDF(profiler, options=options)
+    else:
+        kdf.profiler = profiler
+    try:
+        with profiler.stage("load_kdf"):
+            kdf.load_kdf(epub_dir, db_path)
+        with profiler.stage("update_kdf"):
+            kdf.update_spine_items([epub_dir / item for item in spine_items])
+    finally:
+        if not reuse_kdf:
+            kdf.quit_webdriver()
+
+
+def patch_kpf(
+    kpf_path: Path,
+    epub_source: Path,
+    spine_items: list[str] | None = None,
+    options: ConversionOptions | None = None,
+    profiler: Profiler | None = None,
+    kdf: "KDF | None" = None,
+) -> list[str]:
+    """
+    Update KPF file created from an earlier version of `epub_source`, an
+    EPUB file or unpacked EPUB directory, and replace its "book.epub".
+
+    If `spine_items` is `None`, update the spine documents different from
+    the documents in the old "book.epub". Changed stylesheets and images
+    aren't detected, pass the spine items use them. Return the updated
+    spine items.
+    """
+    import shutil
+    import tempfile
+    import zipfile
+
+    from .archive import write_kpf_archive
+    from .epub import extract_epub, get_epub_metadata
+
+    if profiler is None:
+        profiler = Profiler()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_path = Path(tmpdir)
+        kpf_dir = tmp_path / "kpf"
+        with zipfile.ZipFile(kpf_path) as kpf_zf:
+            kpf_zf.extractall(
+                kpf_dir, [name for name in kpf_zf.namelist() if name != "book.epub"]
+            )
+            if epub_source.is_dir():
+                epub_dir = epub_source
+            else:
+                epub_dir = tmp_path / "epub"
+                with profiler.stage("extract_epub"):
+                    extract_epub(epub_source, epub_dir)
+            if spine_items is None:
+                with kpf_zf.open("book.epub") as old_epub:
+                    spine_items = changed_spine_items(
+                        old_epub, epub_dir, get_epub_metadata(epub_dir).spine_paths
+                    )
+        patch_kdf(
+            kpf_dir / "resources" / "book.kdf",
+            epub_dir,
+            spine_items,
+            options,
+            profiler,
+            kdf,
+        )
+        if kdf is not None:
+            options = kdf.options
+        elif options is None:
+            options = ConversionOptions()
+        tmp_kpf_path = tmp_path / "book.kpf"
+        with profiler.stage("write_kpf"), tmp_kpf_path.open("wb") as dest:
+            if epub_source.is_dir():
+                write_kpf_archive(dest, epub_source, kpf_dir, options.compression_level)
+            else:
+                with epub_source.open("rb") as source:
+                    write_kpf_archive(dest, source, kpf_dir, options.compression_level)
+        shutil.move(tmp_kpf_path, kpf_path)
+    return spine_items
+
+
+def changed_spine_items(old_epub, epub_dir: Path, spine_paths: list[Path]) -> list[str]:
+    """
+    Compare CRC-32 of the spine documents with the files in the old EPUB zip
+    file.
+    """
+    import zipfile
+    import zlib
+
+    spine_items = []
+    with zipfile.ZipFile(old_epub) as zf:
+        old_crcs = {info.filename: info.CRC for info in zf.infolist()}
+    for path in spine_paths:
+        spine_item = path.relative_to(epub_dir).as_posix()
+        if old_crcs.get(spine_item) != zlib.crc32(path.read_bytes()):
+            spine_items.append(spine_item)
+    return spine_items
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class Timing:
+    wall: float = 0.0
+    cpu: float = 0.0
+    calls: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"wall": self.wall, "cpu": self.cpu, "calls": self.calls}
+
+
+@dataclass
+class FragmentStats:
+    count: int = 0
+    size: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"count": self.count, "bytes": self.size}
+
+
+class Profiler:
+    """
+    Collect wall and CPU time per stage and per spine item, plus counters.
+
+    Stages can nest, times are inclusive. CPU time is measured per thread.
+    Pass an instance to `create_kpf` and read `report()` afterwards to forward
+    the data to other metrics systems.
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, Timing] = {}
+        self.spine_items: dict[str, Timing] = {}
+        self.fragments: dict[str, FragmentStats] = {}
+        self.counters: Counter[str] = Counter()
+        self.incidents: list[dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        with self.measure(self.stages, name):
+            yield
+
+    @contextmanager
+    def spine_item(self, name: str) -> Iterator[None]:
+        with self.measure(self.spine_items, name):
+            yield
+
+    @contextmanager
+    def measure(self, timings: dict[str, Timing], name: str) -> Iterator[None]:
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(
+                timings,
+                name,
+                time.perf_counter() - start_wall,
+                time.thread_time() - start_cpu,
+            )
+
+    def add_time(
+        self, timings: dict[str, Timing], name: str, wall: float, cpu: float
+    ) -> None:
+        with self.lock:
+            timing = timings.setdefault(name, Timing())
+            timing.wall += wall
+            timing.cpu += cpu
+            timing.calls += 1
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += value
+
+    def add_incident(self, incident: dict[str, Any]) -> None:
+        with self.lock:
+            self.incidents.append(incident)
+
+    def add_fragment(self, fragment_type: str, size: int) -> None:
+        with self.lock:
+            stats = self.fragments.setdefault(fragment_type, FragmentStats())
+            stats.count += 1
+            stats.size += size
+
+    def merge(self, report: dict[str, Any]) -> None:
+        """
+        Add a report from another process, except its total times.
+        """
+        with self.lock:
+            for timings, data in (
+                (self.stages, report["stages"]),
+                (self.spine_items, report["spine_items"]),
+            ):
+                for name, timing_data in data.items():
+                    timing = timings.setdefault(name, Timing())
+                    timing.wall += timing_data["wall"]
+                    timing.cpu += timing_data["cpu"]
+                    timing.calls += timing_data["calls"]
+            for name, fragment_data in report["fragments"].items():
+                stats = self.fragments.setdefault(name, FragmentStats())
+                stats.count += fragment_data["count"]
+                stats.size += fragment_data["bytes"]
+            self.counters.update(report["counters"])
+            self.incidents.extend(report["incidents"])
+
+    def report(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "wall": time.perf_counter() - self.start_wall,
+                "cpu": time.process_time() - self.start_cpu,
+                "stages": {k: v.to_dict() for k, v in self.stages.items()},
+                "spine_items": {k: v.to_dict() for k, v in self.spine_items.items()},
+                "fragments": {k: v.to_dict() for k, v in self.fragments.items()},
+                "counters": dict(self.counters),
+                "incidents": list(self.incidents),
+            }
+
+    def write_json(self, path: Path) -> None:
+        import json
+
+        with path.open("w") as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
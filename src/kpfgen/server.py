@@ -0,0 +1,417 @@
+"""
+Long-running conversion service keeps a pool of warm `KDF` renderers.
+
+POST /jobs         EPUB file in the request body, or JSON `{"path": "book.epub"}`
+                   if the service is started with `--path-root`
+POST /convert      same as POST /jobs but wait and respond with the KPF file, the
+                   job is removed after the response
+GET /jobs/ID       job status
+GET /jobs/ID/kpf   KPF file of a finished job
+DELETE /jobs/ID    remove a finished job and its files
+GET /stats         queue depth, latency percentiles and throughput
+"""
+
+import json
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from queue import Empty, Full, Queue
+from typing import TYPE_CHECKING, Any, Callable
+
+from .options import ConversionOptions
+
+if TYPE_CHECKING:
+    from .kdf import KDF
+
+
+@dataclass
+class Job:
+    id: str
+    epub_path: Path
+    status: str = "queued"  # running, done, failed
+    error: str = ""
+    kpf_path: Path | None = None
+    submitted: float = field(default_factory=time.time)
+    started: float = 0.0
+    finished: float = 0.0
+    done: threading.Event = field(default_factory=threading.Event)
+
+    def to_dict(self) -> dict[str, Any]:
+        data: dict[str, Any] = {"id": self.id, "status": self.status}
+        if self.error:
+            data["error"] = self.error
+        if self.finished > 0:
+            data["queue_time"] = self.started - self.submitted
+            data["conversion_time"] = self.finished - self.started
+        return data
+
+
+class ConversionService:
+    """
+    Run conversion jobs in `workers` threads, each thread owns a `KDF` and its
+    browser for the lifetime of the service.
+
+    `kdf_factory` creates the renderers, pass one uses
+    `static_render.StaticDriver` to run the service without Firefox.
+    `submit_path()` only reads files in `path_root`, and is disabled if it's
+    `None`.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        queue_size: int = 100,
+        options: ConversionOptions | None = None,
+        kdf_factory: Callable[[], "KDF"] | None = None,
+        max_finished_jobs: int = 1000,
+        path_root: Path | None = None,
+    ) -> None:
+        import tempfile
+
+        self.options = ConversionOptions() if options is None else options
+        self.path_root = None if path_root is None else path_root.resolve()
+        self.kdf_factory = kdf_factory
+        self.max_finished_jobs = max_finished_jobs
+        self.queue: Queue[Job | None] = Queue(queue_size)
+        self.jobs: dict[str, Job] = {}
+        self.finished_jobs: deque[str] = deque()
+        self.lock = threading.Lock()
+        self.job_dir = Path(tempfile.mkdtemp(prefix="kpfgen-"))
+        self.started = time.time()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        # latencies and finish times of recent jobs
+        self.latencies: deque[float] = deque(maxlen=1000)
+        self.finish_times: deque[float] = deque(maxlen=1000)
+        self.workers = [
+            threading.Thread(target=self.worker, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.workers:
+            thread.start()
+
+    def create_kdf(self) -> "KDF":
+        from .kdf import KDF
+
+        if self.kdf_factory is not None:
+            return self.kdf_factory()
+        return KDF(options=self.options)
+
+    def submit_path(self, epub_path: Path) -> Job:
+        """
+        Raise `queue.Full` if there are too many queued jobs, and
+        `PermissionError` if the file isn't in `path_root`.
+        """
+        import shutil
+
+        if self.path_root is None:
+            raise PermissionError("path submissions are disabled")
+        epub_path = epub_path.resolve()
+        if not epub_path.is_relative_to(self.path_root):
+            raise PermissionError(f"{epub_path} isn't in the path root")
+        return self.add_job(lambda path: shutil.copyfile(epub_path, path))
+
+    def submit_bytes(self, epub_data: bytes) -> Job:
+        """
+        Raise `queue.Full` if there are too many queued jobs.
+        """
+        return self.add_job(lambda path: path.write_bytes(epub_data))
+
+    def add_job(self, write_epub: Callable[[Path], Any]) -> Job:
+        import shutil
+        import uuid
+
+        job_id = uuid.uuid4().hex
+        job_path = self.job_dir / job_id
+        job_path.mkdir()
+        job = Job(job_id, job_path / "book.epub")
+        try:
+            write_epub(job.epub_path)
+            self.queue_job(job)
+        except BaseException:
+            shutil.rmtree(job_path)
+            raise
+        return job
+
+    def queue_job(self, job: Job) -> None:
+        with self.lock:
+            self.jobs[job.id] = job
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            with self.lock:
+                del self.jobs[job.id]
+            raise
+
+    def get_job(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def remove_job(self, job_id: str) -> bool:
+        import shutil
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or not job.done.is_set():
+                return False
+            del self.jobs[job_id]
+        shutil.rmtree(self.job_dir / job_id, ignore_errors=True)
+        return True
+
+    def worker(self) -> None:
+        """
+        Create the renderer when the service starts, and again for the next
+        job if that failed. Jobs fail with the setup error instead of staying
+        queued.
+        """
+        import logging
+
+        from .main import create_kpf
+        from .profiling import Profiler
+
+        kdf = None
+        try:
+            kdf = self.create_kdf()
+        except Exception:
+            logging.exception("Creating the renderer failed")
+        try:
+            while (job := self.queue.get()) is not None:
+                with self.lock:
+                    self.running += 1
+                job.status = "running"
+                job.started = time.time()
+                try:
+                    if kdf is None:
+                        kdf = self.create_kdf()
+                    job.kpf_path = create_kpf(job.epub_path, Profiler(), kdf=kdf)
+                    job.status = "done"
+                except Exception as e:
+                    logging.exception("Conversion job %s failed", job.id)
+                    job.status = "failed"
+                    job.error = repr(e)
+                    # the browser may be in a bad state
+                    if kdf is not None:
+                        kdf.quit_webdriver()
+                job.finished = time.time()
+                self.finish_job(job)
+        finally:
+            if kdf is not None:
+                kdf.quit_webdriver()
+
+    def finish_job(self, job: Job) -> None:
+        import shutil
+
+        with self.lock:
+            self.running -= 1
+            if job.status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.latencies.append(job.finished - job.submitted)
+            self.finish_times.append(job.finished)
+            self.finished_jobs.append(job.id)
+            while len(self.finished_jobs) > self.max_finished_jobs:
+                old_job_id = self.finished_jobs.popleft()
+                if self.jobs.pop(old_job_id, None) is not None:
+                    shutil.rmtree(self.job_dir / old_job_id, ignore_errors=True)
+        job.done.set()
+
+    def stats(self) -> dict[str, Any]:
+        now = time.time()
+        with self.lock:
+            latencies = sorted(self.latencies)
+            recent_jobs = sum(1 for t in self.finish_times if now - t <= 60)
+            return {
+                "queue_depth": self.queue.qsize(),
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "workers": len(self.workers),
+                "uptime": now - self.started,
+                "latency": {
+                    f"p{p}": percentile(latencies, p) for p in (50, 90, 95, 99)
+                },
+                # jobs per minute
+                "throughput": recent_jobs,
+            }
+
+    def close(self) -> None:
+        import shutil
+
+        for _ in self.workers:
+            self.queue.put(None)
+        for thread in self.workers:
+            thread.join()
+        # drop jobs submitted after the workers stopped
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Empty:
+            pass
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+
+def percentile(sorted_values: list[float], p: int) -> float | None:
+    if len(sorted_values) == 0:
+        return None
+    index = max(0, round(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    server: "ConversionServer"
+
+    def address_string(self) -> str:
+        # Unix socket clients don't have address
+        if isinstance(self.client_address, tuple):
+            return str(self.client_address[0])
+        return "unix"
+
+    def do_GET(self) -> None:
+        service = self.server.service
+        parts = self.path.strip("/").split("/")
+        if parts == ["stats"]:
+            self.send_json(HTTPStatus.OK, service.stats())
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = service.get_job(parts[1])
+            if job is None:
+                self.send_json(HTTPStatus.NOT_FOUND, {"error": "job not found"})
+            elif len(parts) == 2:
+                self.send_json(HTTPStatus.OK, job.to_dict())
+            elif parts[2] == "kpf" and job.kpf_path is not None:
+                self.send_file(job.kpf_path)
+            else:
+                self.send_json(HTTPStatus.CONFLICT, job.to_dict())
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        service = self.server.service
+        if self.path not in ("/jobs", "/convert"):
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.headers.get_content_type() == "application/json":
+                job = service.submit_path(Path(json.loads(body)["path"]))
+            else:
+                job = service.submit_bytes(body)
+        except Full:
+            self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {"error": "queue is full"})
+            return
+        except PermissionError as e:
+            self.send_json(HTTPStatus.FORBIDDEN, {"error": str(e)})
+            return
+        except (OSError, KeyError, ValueError) as e:
+            self.send_json(HTTPStatus.BAD_REQUEST, {"error": repr(e)})
+            return
+        if self.path == "/jobs":
+            self.send_json(HTTPStatus.ACCEPTED, job.to_dict())
+            return
+        job.done.wait()
+        try:
+            if job.kpf_path is not None:
+                self.send_file(job.kpf_path)
+            else:
+                self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, job.to_dict())
+        finally:
+            service.remove_job(job.id)
+
+    def do_DELETE(self) -> None:
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "jobs":
+            if self.server.service.remove_job(parts[1]):
+                self.send_json(HTTPStatus.OK, {"id": parts[1]})
+            else:
+                self.send_json(
+                    HTTPStatus.CONFLICT, {"error": "job not found or not finished"}
+                )
+        else:
+            self.send_json(HTTPStatus.NOT_FOUND, {"error": "not found"})
+
+    def send_json(self, status: HTTPStatus, data: dict[str, Any]) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, path: Path) -> None:
+        import shutil
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(path.stat().st_size))
+        self.end_headers()
+        with path.open("rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Any, service: ConversionService) -> None:
+        self.service = service
+        if isinstance(address, Path):
+            self.address_family = socket.AF_UNIX
+            address.unlink(True)
+            address = str(address)
+        super().__init__(address, ConversionHandler)
+
+    def server_bind(self) -> None:
+        if self.address_family == socket.AF_UNIX:
+            # `HTTPServer.server_bind()` expects a host and port
+            self.socket.bind(self.server_address)
+            self.server_address = self.socket.getsockname()
+            self.server_name = "localhost"
+            self.server_port = 0
+        else:
+            super().server_bind()
+
+
+def main(argv: list[str]) -> None:
+    import argparse
+
+    from .main import add_conversion_arguments, conversion_options
+
+    parser = argparse.ArgumentParser(prog="kpfgen serve")
+    parser.add_argument(
+        "--socket", type=Path, help="Listen on a Unix socket instead of TCP"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of warm browsers"
+    )
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument(
+        "--path-root",
+        type=Path,
+        metavar="DIR",
+        help='Accept JSON {"path": ...} requests for EPUB files in DIR',
+    )
+    add_conversion_arguments(parser)
+    args = parser.parse_args(argv)
+
+    service = ConversionService(
+        args.workers,
+        args.queue_size,
+        conversion_options(args),
+        path_root=None if args.path_root is None else args.path_root.expanduser(),
+    )
+    address = args.socket if args.socket is not None else (args.host, args.port)
+    with ConversionServer(address, service) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+            if args.socket is not None:
+                args.socket.unlink(True)
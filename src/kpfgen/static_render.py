@@ -0,0 +1,147 @@
+from pathlib import Path
+
+from lxml import etree
+
+BLOCK_TAGS = frozenset(
+    (
+        "address",
+        "article",
+        "aside",
+        "blockquote",
+        "body",
+        "dd",
+        "div",
+        "dl",
+        "dt",
+        "figcaption",
+        "figure",
+        "footer",
+        "h1",
+        "h2",
+        "h3",
+        "h4",
+        "h5",
+        "h6",
+        "header",
+        "hr",
+        "li",
+        "main",
+        "nav",
+        "ol",
+        "p",
+        "pre",
+        "section",
+        "table",
+        "ul",
+    )
+)
+
+
+class StaticElement:
+    """
+    Duck-typed subset of Selenium's `WebElement` backed by an lxml element.
+
+    Layout isn't computed, block tags are decided by tag name.
+    """
+
+    def __init__(self, element: etree._Element, base_path: Path) -> None:
+        self.element = element
+        self.base_path = base_path
+
+    @property
+    def tag_name(self) -> str:
+        return etree.QName(self.element).localname
+
+    @property
+    def text(self) -> str:
+        return " ".join("".join(self.element.itertext()).split())
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, StaticElement) and self.element is other.element
+
+    def __hash__(self) -> int:
+        return id(self.element)
+
+    def find_elements(self, by: str, value: str) -> list["StaticElement"]:
+        """
+        Only XPath is supported.
+        """
+        if value == "*":
+            elements = self.element.iterchildren(etree.Element)
+        else:
+            elements = self.element.xpath(value)
+        return [StaticElement(e, self.base_path) for e in elements]
+
+    def is_displayed(self) -> bool:
+        style = self.element.get("style", "").replace(" ", "")
+        return self.element.get("hidden") is None and "display:none" not in style
+
+    def value_of_css_property(self, name: str) -> str:
+        if name == "display":
+            return "block" if self.tag_name in BLOCK_TAGS else "inline"
+        elif name == "font-size":
+            return "16px"
+        return ""
+
+    def get_attribute(self, name: str) -> str | None:
+        from urllib.parse import unquote
+
+        value = self.element.get(name)
+        if name == "src" and value is not None:
+            return "file://" + str((self.base_path.parent / unquote(value)).resolve())
+        return value
+
+
+def id_elements(
+    body: StaticElement,
+) -> tuple[list[StaticElement], list[int], list[tuple[str, int]]]:
+    """
+    Same as `kdf.ID_ELEMENTS_SCRIPT`: elements of `body` have an id attribute
+    and their ancestors below it, parent indexes, and ids with the indexes of
+    their elements.
+    """
+    elements: list[StaticElement] = []
+    parents: list[int] = []
+    indexes: dict[etree._Element, int] = {}
+
+    def index(element: etree._Element | None) -> int:
+        if element is None or element is body.element:
+            return -1
+        if element not in indexes:
+            parent_index = index(element.getparent())
+            indexes[element] = len(elements)
+            elements.append(StaticElement(element, body.base_path))
+            parents.append(parent_index)
+        return indexes[element]
+
+    ids = [
+        (element.get("id"), index(element))
+        for element in body.element.iterfind(".//*[@id]")
+    ]
+    return elements, parents, ids
+
+
+class StaticDriver:
+    """
+    Duck-typed subset of Selenium's `WebDriver` that parses XHTML files with lxml
+    instead of rendering them in a browser.
+    """
+
+    def __init__(self) -> None:
+        self.root: etree._Element | None = None
+        self.path = Path()
+
+    def get(self, url: str) -> None:
+        self.path = Path(url.removeprefix("file://"))
+        parser = etree.XMLParser(recover=True, resolve_entities=False)
+        self.root = etree.parse(self.path, parser).getroot()
+
+    def find_element(self, by: str, value: str) -> StaticElement:
+        assert self.root is not None
+        body = self.root.find("{*}body")
+        if body is None:
+            body = self.root
+        return StaticElement(body, self.path)
+
+    def quit(self) -> None:
+        self.root = None
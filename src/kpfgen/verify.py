@@ -0,0 +1,264 @@
+"""
+Check references and position maps of a KDF database.
+
+$ kpfgen verify book.kpf
+"""
+
+import sqlite3
+from collections.abc import Collection
+from pathlib import Path
+from typing import Any
+
+from amazon.ion.simple_types import IonPyText
+
+# fields name the structure or navigation container they're in
+INLINE_ID_FIELDS = ("kfx_id", "nav_container_name")
+
+
+def verify_kdf(
+    db_path: Path, resource_names: Collection[str] | None = None
+) -> list[str]:
+    """
+    Return problems of the KDF database, an empty list if it's valid:
+
+    - `child` properties and `kfx_id` values in blobs reference fragments or
+      inline structures that don't exist
+    - resource files of "path" fragments are missing
+    - section position maps don't match `yj.section_pid_count_map`, or
+      `location_map` isn't in reading order or its offsets decrease
+
+    Resource files are looked up next to the database, or in
+    `resource_names` if it isn't `None`, paths are relative to the database
+    directory. Blobs are decoded once as one Ion stream, other checks are SQL
+    queries.
+    """
+    from contextlib import closing
+
+    uri = f"{db_path.resolve().as_uri()}?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as conn:
+        problems = [
+            f"{fragment_id} has child {child_id} doesn't exist"
+            for fragment_id, child_id in conn.execute(
+                """
+                SELECT p.id, p.value FROM fragment_properties p
+                LEFT JOIN fragments f ON f.id = p.value
+                WHERE p.key = 'child' AND f.id IS NULL
+                """
+            )
+        ]
+        problems.extend(
+            f"{fragment_id} resource file {res_path} doesn't exist"
+            for fragment_id, res_path in conn.execute(
+                "SELECT id, payload_value FROM fragments WHERE payload_type = 'path'"
+            )
+            if (
+                not (db_path.parent / res_path).is_file()
+                if resource_names is None
+                else res_path not in resource_names
+            )
+        )
+        fragment_ids = {row[0] for row in conn.execute("SELECT id FROM fragments")}
+        fragments = decode_fragments(conn)
+
+    inline_ids: set[str] = set()
+    references: dict[str, str] = {}
+    for fragment_id, value in fragments.items():
+        collect_ids(fragment_id, value, inline_ids, references)
+    problems.extend(
+        f"{fragment_id} references {reference} doesn't exist"
+        for reference, fragment_id in references.items()
+        if reference not in fragment_ids and reference not in inline_ids
+    )
+    problems.extend(verify_position_maps(fragments))
+    return problems
+
+
+def decode_fragments(conn: sqlite3.Connection) -> dict[str, Any]:
+    """
+    Decode blob fragments in one `simpleion.loads()` call. The symbol table
+    fragment would change the symbols of the values after it, and isn't
+    decoded.
+    """
+    from amazon.ion import simpleion
+
+    # added in amazon.ion 0.12
+    from amazon.ion.simpleion import IonPyValueModel
+
+    fragment_ids = []
+    blobs = [local_symbol_table_header()]
+    for fragment_id, blob in conn.execute(
+        "SELECT id, payload_value FROM fragments "
+        "WHERE payload_type = 'blob' AND id != '$ion_symbol_table'"
+    ):
+        fragment_ids.append(fragment_id)
+        # remove the Ion version marker
+        blobs.append(blob[4:])
+    values = simpleion.loads(
+        b"".join(blobs),
+        single_value=False,
+        value_model=IonPyValueModel.SYMBOL_AS_TEXT | IonPyValueModel.STRUCT_AS_STD_DICT,
+    )
+    return dict(zip(fragment_ids, values))
+
+
+def local_symbol_table_header() -> bytes:
+    """
+    Return Ion version marker and a local symbol table has the YJ symbols
+    at the same symbol ids as the shared table. `simpleion` only uses its C
+    extension without a catalog, which is several times faster.
+    """
+    from .yj_symbols import YJ_CONVERSION_SYMBOLS, YJ_SYMBOLS
+
+    symbols = b"".join(
+        ion_binary_value(8, symbol.encode())
+        for symbol in YJ_SYMBOLS + YJ_CONVERSION_SYMBOLS
+    )
+    # $ion_symbol_table::{symbols: [...]}, symbol ids 3 and 7
+    symbol_table = ion_binary_value(13, b"\x87" + ion_binary_value(11, symbols))
+    return b"\xe0\x01\x00\xea" + ion_binary_value(14, b"\x81\x83" + symbol_table)
+
+
+def ion_binary_value(type_code: int, representation: bytes) -> bytes:
+    length = len(representation)
+    if length < 14:
+        return bytes([type_code << 4 | length]) + representation
+    length_bytes = [length & 0x7F | 0x80]
+    length >>= 7
+    while length > 0:
+        length_bytes.append(length & 0x7F)
+        length >>= 7
+    return bytes([type_code << 4 | 14, *reversed(length_bytes)]) + representation
+
+
+def collect_ids(
+    fragment_id: str, value: Any, inline_ids: set[str], references: dict[str, str]
+) -> None:
+    """
+    Add ids of inline structures to `inline_ids` and other `kfx_id` values
+    to `references`, ids are mapped to the first fragment references them.
+    """
+    stack = [value]
+    while len(stack) > 0:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key, field_value in value.items():
+                if key in INLINE_ID_FIELDS and isinstance(field_value, str):
+                    inline_ids.add(str(field_value))
+                else:
+                    stack.append(field_value)
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, IonPyText) and any(
+            annotation.text == "kfx_id" for annotation in value.ion_annotations
+        ):
+            references.setdefault(str(value), fragment_id)
+
+
+def verify_position_maps(fragments: dict[str, Any]) -> list[str]:
+    """
+    Section position maps start at 1 and increase, and their last position
+    is inside the section length of `yj.section_pid_count_map`.
+    `location_map` lists the structures of the sections in reading order,
+    each offset is the position in the section map minus 1.
+    """
+    problems = []
+    for fragment_id in ("document_data", "yj.section_pid_count_map", "location_map"):
+        if fragment_id not in fragments:
+            problems.append(f"{fragment_id} fragment doesn't exist")
+    if len(problems) > 0:
+        return problems
+    section_ids = [
+        str(section_id)
+        for section_id in fragments["document_data"]["reading_orders"][0]["sections"]
+    ]
+    section_lens = {
+        str(entry["section_name"]): entry["length"]
+        for entry in fragments["yj.section_pid_count_map"]["contains"]
+    }
+    # the cover section isn't counted
+    counted_ids = [
+        section_id for section_id in section_ids if section_id in section_lens
+    ]
+    if counted_ids != section_ids[len(section_ids) - len(counted_ids) :]:
+        problems.append("yj.section_pid_count_map doesn't match the reading order")
+    if len(set(section_lens) - set(section_ids)) > 0:
+        problems.append("yj.section_pid_count_map has sections not in reading order")
+
+    # structure id: section id, position
+    positions: dict[str, tuple[str, int]] = {}
+    for section_id in counted_ids:
+        spm_id = f"{section_id}-spm"
+        if spm_id not in fragments:
+            problems.append(f"{spm_id} fragment doesn't exist")
+            continue
+        contains = fragments[spm_id]["contains"]
+        locations = [location for location, _ in contains]
+        if locations[0] != 1 or any(a > b for a, b in zip(locations, locations[1:])):
+            problems.append(f"{spm_id} positions don't start at 1 or decrease")
+        if len(contains) > 1 and locations[-1] > max(section_lens[section_id], 1):
+            problems.append(
+                f"{spm_id} position {locations[-1]} is larger than section length "
+                f"{section_lens[section_id]}"
+            )
+        # skip the section structure
+        for location, structure_id in contains[1:]:
+            positions[str(structure_id)] = (section_id, location)
+
+    section_order = iter(counted_ids)
+    current_section = ""
+    last_offset = 0
+    for entry in fragments["location_map"]["locations"]:
+        structure_id = str(entry["id"])
+        offset = entry["offset"]
+        if structure_id not in positions:
+            problems.append(f"location_map has {structure_id} not in section maps")
+            continue
+        section_id, location = positions[structure_id]
+        if section_id != current_section:
+            if section_id not in section_order:
+                problems.append(f"location_map section {section_id} isn't in order")
+                break
+            current_section = section_id
+            last_offset = 0
+        if offset < last_offset:
+            problems.append(f"location_map offset of {structure_id} decreases")
+        if offset != location - 1:
+            problems.append(
+                f"location_map offset of {structure_id} is {offset}, "
+                f"section map position is {location}"
+            )
+        last_offset = offset
+    return problems
+
+
+def main(argv: list[str]) -> None:
+    import argparse
+    import sys
+    import tempfile
+    import zipfile
+
+    parser = argparse.ArgumentParser(prog="kpfgen verify")
+    parser.add_argument("path", type=Path, help="KPF or KDF file")
+    args = parser.parse_args(argv)
+
+    path = args.path.expanduser()
+    if zipfile.is_zipfile(path):
+        from .inspection import KDF_MEMBER, RES_PREFIX
+
+        # only the database is extracted, resource files are checked in the
+        # zip file's member names
+        with zipfile.ZipFile(path) as zf, tempfile.TemporaryDirectory() as tmpdir:
+            problems = verify_kdf(
+                Path(zf.extract(KDF_MEMBER, tmpdir)),
+                {
+                    name.removeprefix(RES_PREFIX)
+                    for name in zf.namelist()
+                    if name.startswith(RES_PREFIX)
+                },
+            )
+    else:
+        problems = verify_kdf(path)
+    for problem in problems:
+        print(problem)
+    if len(problems) > 0:
+        sys.exit(1)
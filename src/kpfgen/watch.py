@@ -0,0 +1,181 @@
+"""
+Rebuild the KPF file of an unpacked EPUB directory when its files change,
+with a warm `KDF` that only renders the changed spine documents again.
+"""
+
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from .options import ConversionOptions
+from .profiling import Profiler
+
+if TYPE_CHECKING:
+    from .kdf import KDF
+
+# seconds between scans of the EPUB directory
+POLL_INTERVAL = 0.5
+
+
+def snapshot(epub_dir: Path) -> dict[Path, tuple[int, int]]:
+    """
+    Return modification time and size of every file.
+    """
+    import stat
+
+    files = {}
+    for path in epub_dir.rglob("*"):
+        try:
+            path_stat = path.stat()
+        except OSError:
+            continue
+        if stat.S_ISREG(path_stat.st_mode):
+            files[path] = (path_stat.st_mtime_ns, path_stat.st_size)
+    return files
+
+
+class Watcher:
+    def __init__(
+        self,
+        epub_dir: Path,
+        work_dir: Path,
+        kpf_path: Path,
+        options: ConversionOptions | None = None,
+        kdf: "KDF | None" = None,
+    ) -> None:
+        """
+        `work_dir` keeps the KDF database and other KPF files between
+        builds.
+        """
+        from .kdf import KDF
+        from .main import create_kcb, create_manifest_file
+
+        self.epub_dir = epub_dir.resolve()
+        self.kpf_path = kpf_path
+        self.kpf_dir = work_dir / "kpf"
+        self.resources_dir = self.kpf_dir / "resources"
+        self.resources_dir.mkdir(parents=True, exist_ok=True)
+        create_kcb(self.kpf_dir)
+        create_manifest_file(self.resources_dir)
+        self.kdf = KDF(options=options) if kdf is None else kdf
+        self.files = snapshot(self.epub_dir)
+        # the database may be inconsistent after a failed update
+        self.needs_full_build = True
+
+    def build(self) -> None:
+        self.kdf.profiler = Profiler()
+        self.kdf.create_kdf(self.epub_dir, self.resources_dir / "book.kdf")
+        self.needs_full_build = False
+        self.write_kpf()
+
+    def update(self, spine_paths: list[Path]) -> None:
+        self.kdf.profiler = Profiler()
+        self.needs_full_build = True
+        self.kdf.update_spine_items(spine_paths)
+        self.needs_full_build = False
+        self.write_kpf()
+
+    def write_kpf(self) -> None:
+        from .archive import write_kpf_archive
+
+        # Kindle Previewer never sees a partial file
+        tmp_path = self.kpf_path.with_name(self.kpf_path.name + ".tmp")
+        with tmp_path.open("wb") as dest:
+            write_kpf_archive(
+                dest, self.epub_dir, self.kpf_dir, self.kdf.options.compression_level
+            )
+        tmp_path.replace(self.kpf_path)
+
+    def changed_spine_paths(self, changed_paths: set[Path]) -> list[Path] | None:
+        """
+        Return spine documents need to be rendered again, or `None` if the
+        book needs a full build. A changed stylesheet, image or other
+        manifest item may be used by every spine document.
+        """
+        metadata = self.kdf.epub_metadata
+        book_paths = {self.epub_dir / "META-INF" / "container.xml", metadata.opf_path}
+        if metadata.toc is not None:
+            book_paths.add(metadata.toc)
+        if metadata.cover_path is not None:
+            book_paths.add(metadata.cover_path)
+        book_paths = {path.resolve() for path in book_paths}
+        spine_paths = [path.resolve() for path in metadata.spine_paths]
+        manifest_paths = {
+            metadata.item_path(item).resolve() for item in metadata.manifest.items
+        }
+        # ignore files not in the book, like editor backups
+        changed_paths &= manifest_paths | book_paths
+        if not book_paths.isdisjoint(changed_paths) or not all(
+            path.exists() for path in spine_paths
+        ):
+            return None
+        if not changed_paths.issubset(spine_paths):
+            return metadata.spine_paths
+        return [
+            path
+            for path, resolved in zip(metadata.spine_paths, spine_paths)
+            if resolved in changed_paths
+        ]
+
+    def poll(self) -> bool:
+        """
+        Rebuild if files changed since the last call, return `True` if the
+        KPF file is rebuilt.
+        """
+        files = snapshot(self.epub_dir)
+        changed_paths = {
+            path
+            for path in files.keys() | self.files.keys()
+            if files.get(path) != self.files.get(path)
+        }
+        self.files = files
+        if len(changed_paths) == 0 and not self.needs_full_build:
+            return False
+        start = time.perf_counter()
+        spine_paths = None
+        if not self.needs_full_build:
+            spine_paths = self.changed_spine_paths(changed_paths)
+            if spine_paths is not None and len(spine_paths) == 0:
+                return False
+        try:
+            if spine_paths is None:
+                self.build()
+                message = "Built the book"
+            else:
+                self.update(spine_paths)
+                message = f"Rebuilt {len(spine_paths)} spine documents"
+        except Exception as e:
+            print(f"Build failed: {e!r}", file=sys.stderr)
+            # the browser may be in a bad state
+            self.kdf.quit_webdriver()
+            return False
+        print(f"{message} in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+        return True
+
+    def run(self) -> None:
+        while True:
+            self.poll()
+            time.sleep(POLL_INTERVAL)
+
+
+def watch(epub_dir: Path, options: ConversionOptions | None = None) -> None:
+    """
+    Create KPF file next to the EPUB directory and rebuild it when the
+    directory changes, until interrupted.
+    """
+    import dataclasses
+    import tempfile
+
+    if options is None:
+        options = ConversionOptions()
+    options = dataclasses.replace(options, memory_cache=False)
+    kpf_path = epub_dir.with_suffix(".kpf")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        watcher = Watcher(epub_dir, Path(tmpdir), kpf_path, options)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.kdf.quit_webdriver()
@@ -0,0 +1,440 @@
+import sqlite3
+import threading
+from pathlib import Path
+from queue import Queue
+from typing import Any, Callable, Iterable, Sequence
+
+from .profiling import Profiler
+
+Encoder = Callable[[Any, str], bytes]
+
+
+def create_kdf_tables(
+    db_path: Path, check_same_thread: bool = True
+) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    conn.executescript(
+        """
+        CREATE TABLE capabilities(
+            key char(20), version smallint, primary key (key, version)
+        ) without rowid;
+
+        CREATE TABLE fragments(
+            id char(40), payload_type char(10), payload_value blob, primary key (id)
+        );
+
+        CREATE TABLE fragment_properties(
+            id char(40), key char(40), value char(40), primary key (id, key, value)
+        ) without rowid;
+
+        CREATE TABLE gc_fragment_properties(
+            id varchar(40), key varchar(40), value varchar(40),
+            primary key (id, key, value)
+        ) without rowid;
+
+        CREATE TABLE gc_reachable(id varchar(40), primary key (id)) without rowid;
+
+        INSERT INTO capabilities VALUES('db.schema', 1);
+        """
+    )
+    return conn
+
+
+def connect_kdf(
+    db_path: Path, resume: bool, check_same_thread: bool = True
+) -> sqlite3.Connection:
+    if resume:
+        return sqlite3.connect(db_path, check_same_thread=check_same_thread)
+    return create_kdf_tables(db_path, check_same_thread)
+
+
+def optimize_kdf(db_path: Path) -> None:
+    """
+    Index `fragment_properties` by key and value, choose a page size fits
+    most fragments, update the query planner statistics and rebuild the
+    database file without free pages.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS fragment_properties_key_value "
+            "ON fragment_properties(key, value)"
+        )
+        conn.commit()
+        conn.execute(f"PRAGMA page_size = {choose_page_size(conn)}")
+        conn.execute("ANALYZE")
+        conn.commit()
+        # rewrite the file with the new page size, rows are stored in key order
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def choose_page_size(conn: sqlite3.Connection) -> int:
+    """
+    Return page size larger than 90% of the fragments, between the default
+    4 KiB and SQLite's maximum 64 KiB. Larger fragments are stored in
+    overflow pages.
+    """
+    sizes = [
+        row[0]
+        for row in conn.execute(
+            "SELECT length(payload_value) FROM fragments ORDER BY 1"
+        )
+    ]
+    if len(sizes) == 0:
+        return 4096
+    size = sizes[int(len(sizes) * 0.9)]
+    page_size = 4096
+    while page_size < size and page_size < 65536:
+        page_size *= 2
+    return page_size
+
+
+class KDFWriter:
+    """
+    Encode and write fragments to the KDF database on the calling thread.
+    """
+
+    def __init__(
+        self, db_path: Path, encode: Encoder, profiler: Profiler, resume: bool = False
+    ) -> None:
+        """
+        With `resume`, open an existing database instead of creating it.
+        """
+        self.encode = encode
+        self.profiler = profiler
+        self.conn = connect_kdf(db_path, resume)
+
+    def insert_blob_fragment(self, fragment_id: str, ion: Any, annotation: str) -> None:
+        self.write_fragment(fragment_id, "blob", self.encode(ion, annotation))
+
+    def insert_fragment(
+        self, fragment_id: str, payload_type: str, payload_value: str | bytes
+    ) -> None:
+        self.write_fragment(fragment_id, payload_type, payload_value)
+
+    def insert_fragment_properties(self, data: Iterable[tuple[str, str, str]]) -> None:
+        self.write_fragment_properties(data)
+
+    def write_fragment(
+        self, fragment_id: str, payload_type: str, payload_value: str | bytes
+    ) -> None:
+        with self.profiler.stage("sqlite"):
+            self.conn.execute(
+                "INSERT INTO fragments VALUES(?, ?, ?)",
+                (fragment_id, payload_type, payload_value),
+            )
+
+    def write_fragment_properties(self, data: Iterable[tuple[str, str, str]]) -> None:
+        with self.profiler.stage("sqlite"):
+            self.conn.executemany(
+                "INSERT INTO fragment_properties VALUES(?, ?, ?)", data
+            )
+
+    def savepoint(self) -> None:
+        self.execute("SAVEPOINT spine_item")
+
+    def release(self) -> None:
+        self.execute("RELEASE spine_item")
+
+    def rollback(self) -> None:
+        self.execute("ROLLBACK TO spine_item")
+        self.execute("RELEASE spine_item")
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ()) -> None:
+        with self.profiler.stage("sqlite"):
+            self.conn.execute(sql, parameters)
+
+    def delete_fragments(self, fragment_ids: Sequence[str]) -> None:
+        placeholders = ", ".join("?" * len(fragment_ids))
+        for table in ("fragments", "fragment_properties"):
+            self.execute(
+                f"DELETE FROM {table} WHERE id IN ({placeholders})", fragment_ids
+            )
+
+    def delete_subtree(self, root_ids: Sequence[str]) -> list[str]:
+        """
+        Delete fragments and their properties reachable from `root_ids`
+        through "child" properties. Return paths of the deleted resources.
+        """
+        placeholders = ", ".join("(?)" for _ in root_ids)
+        with self.profiler.stage("sqlite"):
+            self.conn.execute("DROP TABLE IF EXISTS temp.subtree")
+            self.conn.execute(
+                "CREATE TEMP TABLE subtree AS "
+                f"WITH RECURSIVE tree(id) AS (VALUES {placeholders} "
+                "UNION SELECT value FROM fragment_properties JOIN tree USING(id) "
+                "WHERE key = 'child') SELECT id FROM tree",
+                root_ids,
+            )
+            res_paths = [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT payload_value FROM fragments "
+                    "WHERE payload_type = 'path' AND id IN (SELECT id FROM subtree)"
+                )
+            ]
+            for table in ("fragments", "fragment_properties"):
+                self.conn.execute(
+                    f"DELETE FROM {table} WHERE id IN (SELECT id FROM subtree)"
+                )
+            self.conn.execute("DROP TABLE temp.subtree")
+        return res_paths
+
+    def commit(self) -> None:
+        """
+        Return after all fragments inserted before are committed.
+        """
+        with self.profiler.stage("sqlite"):
+            self.conn.commit()
+
+    def collect_garbage(
+        self, root_ids: Iterable[str], root_element_types: Sequence[str], prune: bool
+    ) -> list[str]:
+        """
+        Fill the "gc_reachable" and "gc_fragment_properties" tables with the
+        fragments reachable from `root_ids` and fragments of
+        `root_element_types` through "child" properties. With `prune`,
+        delete unreachable fragments and return paths of the deleted
+        resources.
+        """
+        conn = self.conn
+        with self.profiler.stage("sqlite"):
+            children: dict[str, list[str]] = {}
+            for fragment_id, child_id in conn.execute(
+                "SELECT id, value FROM fragment_properties WHERE key = 'child'"
+            ):
+                children.setdefault(fragment_id, []).append(child_id)
+            placeholders = ", ".join("?" * len(root_element_types))
+            stack = list(root_ids)
+            stack.extend(
+                row[0]
+                for row in conn.execute(
+                    "SELECT id FROM fragment_properties WHERE key = 'element_type' "
+                    f"AND value IN ({placeholders})",
+                    root_element_types,
+                )
+            )
+        with self.profiler.stage("gc_walk"):
+            reachable = set()
+            while len(stack) > 0:
+                fragment_id = stack.pop()
+                if fragment_id not in reachable:
+                    reachable.add(fragment_id)
+                    stack.extend(children.get(fragment_id, ()))
+        res_paths = []
+        with self.profiler.stage("sqlite"):
+            conn.execute("DELETE FROM gc_reachable")
+            conn.execute("DELETE FROM gc_fragment_properties")
+            conn.executemany(
+                "INSERT INTO gc_reachable VALUES(?)", ((i,) for i in reachable)
+            )
+            conn.execute(
+                "DELETE FROM gc_reachable WHERE id NOT IN (SELECT id FROM fragments)"
+            )
+            if prune:
+                res_paths = [
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT payload_value FROM fragments WHERE payload_type = "
+                        "'path' AND id NOT IN (SELECT id FROM gc_reachable)"
+                    )
+                ]
+                for table in ("fragments", "fragment_properties"):
+                    conn.execute(
+                        f"DELETE FROM {table} "
+                        "WHERE id NOT IN (SELECT id FROM gc_reachable)"
+                    )
+            conn.execute(
+                "INSERT INTO gc_fragment_properties SELECT * FROM fragment_properties "
+                "WHERE id IN (SELECT id FROM gc_reachable)"
+            )
+        return res_paths
+
+    def merge(self, db_path: Path) -> None:
+        """
+        Copy fragments of another KDF database, ids must be unique.
+        """
+        with self.profiler.stage("sqlite"):
+            # can't attach database in a transaction
+            self.conn.commit()
+            self.conn.execute("ATTACH DATABASE ? AS shard", (str(db_path),))
+            self.conn.execute("INSERT INTO fragments SELECT * FROM shard.fragments")
+            self.conn.execute(
+                "INSERT INTO fragment_properties "
+                "SELECT * FROM shard.fragment_properties"
+            )
+            self.conn.commit()
+            self.conn.execute("DETACH DATABASE shard")
+
+    def close(self) -> None:
+        with self.profiler.stage("sqlite"):
+            self.conn.commit()
+            self.conn.close()
+
+    def abort(self) -> None:
+        """
+        Close the database without committing, after the conversion failed.
+        """
+        self.conn.close()
+
+
+class PipelinedKDFWriter(KDFWriter):
+    """
+    Encode fragments in worker threads and write them in a single writer thread
+    that owns the SQLite connection.
+
+    The KDF renderer blocks when `queue_size` operations are submitted and
+    not applied yet, this bounds the queues and the buffer of operations
+    encoded ahead of a slow one. Every operation has a sequence number and
+    the writer thread applies them in the order they were submitted, so the
+    database is the same as `KDFWriter` creates.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        encode: Encoder,
+        profiler: Profiler,
+        workers: int,
+        queue_size: int,
+        resume: bool = False,
+    ) -> None:
+        self.db_path = db_path
+        self.resume = resume
+        self.encode = encode
+        self.profiler = profiler
+        self.sequence = 0
+        self.error: BaseException | None = None
+        self.in_flight = threading.BoundedSemaphore(queue_size)
+        self.encode_queue: Queue[tuple[int, str, Any] | None] = Queue(queue_size)
+        self.write_queue: Queue[tuple[int, str, Any] | None] = Queue(queue_size)
+        self.conn_ready = threading.Event()
+        self.encoders = [
+            threading.Thread(target=self.encode_worker, daemon=True)
+            for _ in range(workers)
+        ]
+        self.writer_thread = threading.Thread(target=self.write_worker, daemon=True)
+        for thread in self.encoders + [self.writer_thread]:
+            thread.start()
+        self.conn_ready.wait()
+        if self.error is not None:
+            self.stop_threads()
+            self.raise_error()
+
+    def submit(self, operation: str, data: Any) -> None:
+        self.raise_error()
+        with self.profiler.stage("pipeline_wait"):
+            self.in_flight.acquire()
+            self.encode_queue.put((self.sequence, operation, data))
+        self.sequence += 1
+
+    def raise_error(self) -> None:
+        if self.error is not None:
+            raise RuntimeError("KDF pipeline failed") from self.error
+
+    def insert_blob_fragment(self, fragment_id: str, ion: Any, annotation: str) -> None:
+        self.submit("blob", (fragment_id, ion, annotation))
+
+    def insert_fragment(
+        self, fragment_id: str, payload_type: str, payload_value: str | bytes
+    ) -> None:
+        self.submit("fragment", (fragment_id, payload_type, payload_value))
+
+    def insert_fragment_properties(self, data: Iterable[tuple[str, str, str]]) -> None:
+        self.submit("properties", list(data))
+
+    def merge(self, db_path: Path) -> None:
+        self.submit("merge", db_path)
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ()) -> None:
+        self.submit("execute", (sql, parameters))
+
+    def delete_subtree(self, root_ids: Sequence[str]) -> list[str]:
+        # wait for the writer thread, then use its connection on this thread
+        self.commit()
+        return KDFWriter.delete_subtree(self, root_ids)
+
+    def collect_garbage(
+        self, root_ids: Iterable[str], root_element_types: Sequence[str], prune: bool
+    ) -> list[str]:
+        self.commit()
+        return KDFWriter.collect_garbage(self, root_ids, root_element_types, prune)
+
+    def commit(self) -> None:
+        done = threading.Event()
+        self.submit("commit", done)
+        done.wait()
+        self.raise_error()
+
+    def encode_worker(self) -> None:
+        while (item := self.encode_queue.get()) is not None:
+            sequence, operation, data = item
+            if operation == "blob":
+                fragment_id, ion, annotation = data
+                try:
+                    item = (
+                        sequence,
+                        "fragment",
+                        (fragment_id, "blob", self.encode(ion, annotation)),
+                    )
+                except BaseException as e:
+                    item = (sequence, "error", e)
+            self.write_queue.put(item)
+
+    def write_worker(self) -> None:
+        try:
+            self.conn = connect_kdf(self.db_path, self.resume, check_same_thread=False)
+        except BaseException as e:
+            self.error = e
+        self.conn_ready.set()
+        pending: dict[int, tuple[str, Any]] = {}
+        next_sequence = 0
+        while (item := self.write_queue.get()) is not None:
+            sequence, operation, data = item
+            pending[sequence] = (operation, data)
+            while next_sequence in pending:
+                operation, data = pending.pop(next_sequence)
+                next_sequence += 1
+                # keep draining the queue after an error so the producer never
+                # blocks
+                if self.error is None:
+                    try:
+                        self.apply(operation, data)
+                    except BaseException as e:
+                        self.error = e
+                if operation == "commit":
+                    data.set()
+                self.in_flight.release()
+
+    def apply(self, operation: str, data: Any) -> None:
+        if operation == "fragment":
+            self.write_fragment(*data)
+        elif operation == "properties":
+            self.write_fragment_properties(data)
+        elif operation == "execute":
+            KDFWriter.execute(self, *data)
+        elif operation == "merge":
+            KDFWriter.merge(self, data)
+        elif operation == "commit":
+            KDFWriter.commit(self)
+        elif operation == "error":
+            raise data
+
+    def close(self) -> None:
+        self.stop_threads()
+        self.raise_error()
+        KDFWriter.close(self)
+
+    def abort(self) -> None:
+        self.stop_threads()
+        KDFWriter.abort(self)
+
+    def stop_threads(self) -> None:
+        for _ in self.encoders:
+            self.encode_queue.put(None)
+        for thread in self.encoders:
+            thread.join()
+        self.write_queue.put(None)
+        self.writer_thread.join()
@@ -0,0 +1,110 @@
+import io
+import os
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from kpfgen import archive
+from kpfgen.archive import write_kpf_archive
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+
+
+class NonSeekable(io.RawIOBase):
+    def __init__(self, f: io.BytesIO) -> None:
+        self.f = f
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        return self.f.write(b)
+
+
+def create_files(tmp_path: Path) -> tuple[Path, Path]:
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    epub_dir = tmp_path / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    (epub_dir / "mimetype").write_text("application/epub+zip")
+    kpf_dir = tmp_path / "kpf"
+    res_dir = kpf_dir / "resources" / "res"
+    res_dir.mkdir(parents=True)
+    (kpf_dir / "book.kcb").write_text('{"book_state": {}}')
+    (kpf_dir / "resources" / "book.kdf").write_bytes(b"SQLite format 3\0" * 10000)
+    (res_dir / "empty").write_bytes(b"")
+    (res_dir / "random").write_bytes(os.urandom(100000))
+    (res_dir / "image").write_bytes(b"\x89PNG" + bytes(100000))
+    return epub_dir, kpf_dir
+
+
+@pytest.mark.parametrize("precompressed", [True, False])
+@pytest.mark.parametrize("seekable", [True, False])
+def test_write_kpf_archive(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    precompressed: bool,
+    seekable: bool,
+) -> None:
+    if precompressed and not archive.PRECOMPRESSED_MEMBERS:
+        pytest.skip("zipfile internals of this Python version aren't checked")
+    monkeypatch.setattr(archive, "PRECOMPRESSED_MEMBERS", precompressed)
+    epub_dir, kpf_dir = create_files(tmp_path)
+    buffer = io.BytesIO()
+    dest = buffer if seekable else io.BufferedWriter(NonSeekable(buffer))
+    write_kpf_archive(dest, epub_dir, kpf_dir)
+    dest.flush()
+
+    with zipfile.ZipFile(buffer) as zf:
+        assert zf.testzip() is None
+        for path in kpf_dir.rglob("*"):
+            if path.is_file():
+                name = path.relative_to(kpf_dir).as_posix()
+                assert zf.read(name) == path.read_bytes()
+        compress_types = {
+            name: zf.getinfo(name).compress_type
+            for name in (
+                "book.epub",
+                "resources/book.kdf",
+                "resources/res/empty",
+                "resources/res/random",
+                "resources/res/image",
+            )
+        }
+        assert compress_types == {
+            "book.epub": zipfile.ZIP_STORED,
+            "resources/book.kdf": zipfile.ZIP_DEFLATED,
+            "resources/res/empty": zipfile.ZIP_STORED,
+            "resources/res/random": zipfile.ZIP_STORED,
+            "resources/res/image": zipfile.ZIP_DEFLATED,
+        }
+        with (
+            zf.open("book.epub") as f,
+            zipfile.ZipFile(io.BytesIO(f.read())) as epub_zf,
+        ):
+            assert epub_zf.testzip() is None
+            assert epub_zf.namelist()[0] == "mimetype"
+            assert epub_zf.getinfo("mimetype").compress_type == zipfile.ZIP_STORED
+
+
+def test_epub_dir_skips_other_files(tmp_path: Path) -> None:
+    epub_dir, kpf_dir = create_files(tmp_path)
+    with zipfile.ZipFile(tmp_path / "book.epub") as zf:
+        epub_names = sorted(zf.namelist())
+    (epub_dir / ".git").mkdir()
+    (epub_dir / ".git" / "config").write_text("[core]")
+    (epub_dir / "build").mkdir()
+    (epub_dir / "build" / "book.epub").write_bytes(b"PK")
+    (epub_dir / "OEBPS" / "chapter0.xhtml~").write_text("backup")
+    (epub_dir / "OEBPS" / ".chapter0.xhtml.swp").write_text("swap")
+    (epub_dir / "META-INF" / ".DS_Store").write_text("")
+    (epub_dir / "META-INF" / "container.xml~").write_text("backup")
+
+    buffer = io.BytesIO()
+    write_kpf_archive(buffer, epub_dir, kpf_dir)
+    with (
+        zipfile.ZipFile(buffer) as zf,
+        zf.open("book.epub") as f,
+        zipfile.ZipFile(io.BytesIO(f.read())) as epub_zf,
+    ):
+        assert sorted(epub_zf.namelist()) == epub_names
@@ -0,0 +1,40 @@
+import re
+import shutil
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+from kpfgen.kdf import KDF
+from kpfgen.options import ConversionOptions
+
+pytestmark = pytest.mark.skipif(
+    shutil.which("geckodriver") is None, reason="needs Firefox and geckodriver"
+)
+
+
+def fragments(db_path: Path) -> list[tuple]:
+    with sqlite3.connect(db_path) as conn:
+        return sorted(conn.execute("SELECT * FROM fragments"))
+
+
+def test_block_images_same_as_default(tmp_path: Path) -> None:
+    generate_epub(PRESETS["images"], tmp_path / "book.epub")
+    epub_dir = tmp_path / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    # images without size and alt text aren't displayed if they're not sized
+    for path in epub_dir.rglob("*.xhtml"):
+        path.write_text(re.sub(r' alt="[^"]*"', "", path.read_text()))
+    results = []
+    for block_images in (False, True):
+        db_path = tmp_path / str(block_images) / "book.kdf"
+        db_path.parent.mkdir()
+        kdf = KDF(options=ConversionOptions(block_images=block_images))
+        try:
+            kdf.create_kdf(epub_dir, db_path)
+        finally:
+            kdf.quit_webdriver()
+        results.append(fragments(db_path))
+    assert results[0] == results[1]
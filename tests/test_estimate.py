@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from kpfgen.benchmark import BenchmarkSpec, generate_epub
+from kpfgen.estimate import (
+    STATIC_RENDER_COST_MODEL,
+    estimate_epub,
+    fit_cost_model,
+    scan_epub,
+)
+
+RESULTS_PATH = Path(__file__).parent.parent / "benchmarks" / "no-browser.json"
+
+
+def test_static_render_cost_model(tmp_path: Path) -> None:
+    with RESULTS_PATH.open() as f:
+        results = json.load(f)
+    model = fit_cost_model(results, "create_kdf_static")
+    for fitted, default in (
+        (model.time, STATIC_RENDER_COST_MODEL.time),
+        (model.peak_memory, STATIC_RENDER_COST_MODEL.peak_memory),
+    ):
+        assert fitted.keys() == default.keys()
+        for feature, coefficient in default.items():
+            assert fitted[feature] == pytest.approx(coefficient, rel=0.01)
+
+    epub_path = tmp_path / "book.epub"
+    for case in results["cases"].values():
+        generate_epub(BenchmarkSpec(**case["spec"]), epub_path)
+        estimate = STATIC_RENDER_COST_MODEL.predict(scan_epub(epub_path))
+        stage = case["stages"]["create_kdf_static"]
+        assert estimate["time"] == pytest.approx(stage["time"], rel=0.2)
+        assert estimate["peak_memory"] == pytest.approx(stage["peak_memory"], rel=0.2)
+
+
+def test_estimate_requires_calibration(tmp_path: Path) -> None:
+    with RESULTS_PATH.open() as f:
+        results = json.load(f)
+    # static render results can't calibrate the conversion estimate
+    with pytest.raises(ValueError):
+        fit_cost_model(results)
+
+    epub_path = tmp_path / "book.epub"
+    generate_epub(BenchmarkSpec(**results["cases"]["small"]["spec"]), epub_path)
+    result = estimate_epub(epub_path)
+    assert "estimate" not in result
+    assert result["static_render_estimate"]["time"] > 0
+    model = fit_cost_model(results, "create_kdf_static")
+    assert estimate_epub(epub_path, model)["estimate"] == model.predict(
+        scan_epub(epub_path)
+    )
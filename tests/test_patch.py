@@ -0,0 +1,49 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import pytest
+
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+from kpfgen.kdf import KDF
+from kpfgen.options import ConversionOptions
+from kpfgen.patch import patch_kdf
+from kpfgen.static_render import StaticDriver
+from kpfgen.verify import decode_fragments, verify_kdf
+
+
+def structure_ids(db_path: Path) -> list[str]:
+    with closing(sqlite3.connect(db_path)) as conn:
+        fragments = decode_fragments(conn)
+    return [
+        str(structure_id)
+        for fragment_id, value in fragments.items()
+        if fragment_id.endswith("-spm")
+        for _, structure_id in value["contains"]
+    ]
+
+
+@pytest.mark.parametrize("content_fragments", [False, True])
+def test_patch_kdf(tmp_path: Path, content_fragments: bool) -> None:
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    epub_dir = tmp_path / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    db_path = tmp_path / "kdf" / "book.kdf"
+    db_path.parent.mkdir()
+    options = ConversionOptions(content_fragments=content_fragments)
+    KDF(webdriver=StaticDriver(), options=options).create_kdf(epub_dir, db_path)
+
+    chapter_path = epub_dir / "OEBPS" / "chapter1.xhtml"
+    chapter_path.write_text(
+        chapter_path.read_text().replace("<h1>", "<p>New paragraph</p><h1>")
+    )
+    patch_kdf(
+        db_path,
+        epub_dir,
+        ["OEBPS/chapter1.xhtml"],
+        kdf=KDF(webdriver=StaticDriver(), options=options),
+    )
+    assert verify_kdf(db_path) == []
+    ids = structure_ids(db_path)
+    assert len(ids) == len(set(ids))
@@ -0,0 +1,52 @@
+import random
+import sqlite3
+from pathlib import Path
+
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+from kpfgen.kdf import KDF
+from kpfgen.options import ConversionOptions
+from kpfgen.static_render import StaticDriver
+
+
+def build_kdf(epub_dir: Path, db_path: Path, options: ConversionOptions) -> None:
+    db_path.parent.mkdir()
+    # book id is random
+    random.seed(0)
+    KDF(webdriver=StaticDriver(), options=options).create_kdf(epub_dir, db_path)
+
+
+def fragments(db_path: Path) -> list[tuple]:
+    with sqlite3.connect(db_path) as conn:
+        return sorted(conn.execute("SELECT * FROM fragments"))
+
+
+@pytest.mark.parametrize("content_fragments", [False, True])
+def test_retry_same_as_first_attempt(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, content_fragments: bool
+) -> None:
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    epub_dir = tmp_path / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    options = ConversionOptions(content_fragments=content_fragments)
+    build_kdf(epub_dir, tmp_path / "default" / "book.kdf", options)
+
+    # the browser fails in the middle of the first spine document once
+    create_text_structure = KDF.create_text_structure
+    calls = 0
+
+    def fail_once(self, *args, **kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 4:
+            raise WebDriverException("browser crashed")
+        return create_text_structure(self, *args, **kwargs)
+
+    monkeypatch.setattr(KDF, "create_text_structure", fail_once)
+    build_kdf(epub_dir, tmp_path / "retry" / "book.kdf", options)
+    assert fragments(tmp_path / "retry" / "book.kdf") == fragments(
+        tmp_path / "default" / "book.kdf"
+    )
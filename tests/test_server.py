@@ -0,0 +1,132 @@
+import http.client
+import json
+import socket
+import threading
+import zipfile
+from collections.abc import Iterator
+from io import BytesIO
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.kdf import KDF
+from kpfgen.server import ConversionServer, ConversionService
+from kpfgen.static_render import StaticDriver
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: Path) -> None:
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(str(self.socket_path))
+
+
+@pytest.fixture
+def server(tmp_path: Path) -> Iterator[tuple[ConversionService, Path]]:
+    service = ConversionService(
+        kdf_factory=lambda: KDF(webdriver=StaticDriver()),
+        path_root=tmp_path / "books",
+    )
+    socket_path = tmp_path / "kpfgen.sock"
+    server = ConversionServer(socket_path, service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield service, socket_path
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def request(
+    socket_path: Path,
+    method: str,
+    path: str,
+    body: bytes = b"",
+    content_type: str = "application/epub+zip",
+) -> tuple[int, bytes]:
+    conn = UnixConnection(socket_path)
+    try:
+        conn.request(method, path, body, {"Content-Type": content_type})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def request_json(socket_path: Path, method: str, path: str, **kwargs: Any) -> Any:
+    status, body = request(socket_path, method, path, **kwargs)
+    return status, json.loads(body)
+
+
+def test_convert(tmp_path: Path, server: tuple[ConversionService, Path]) -> None:
+    _, socket_path = server
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    status, body = request(
+        socket_path, "POST", "/convert", (tmp_path / "book.epub").read_bytes()
+    )
+    assert status == 200
+    with zipfile.ZipFile(BytesIO(body)) as zf:
+        assert "resources/book.kdf" in zf.namelist()
+
+
+def test_failed_job(server: tuple[ConversionService, Path]) -> None:
+    service, socket_path = server
+    status, job = request_json(socket_path, "POST", "/jobs", body=b"not a zip")
+    assert status == 202
+    service.jobs[job["id"]].done.wait()
+    status, job = request_json(socket_path, "GET", f"/jobs/{job['id']}")
+    assert status == 200
+    assert job["status"] == "failed"
+    assert "BadZipFile" in job["error"]
+    status, _ = request_json(socket_path, "GET", f"/jobs/{job['id']}/kpf")
+    assert status == 409
+
+
+def test_path_outside_root(
+    tmp_path: Path, server: tuple[ConversionService, Path]
+) -> None:
+    _, socket_path = server
+    (tmp_path / "books").mkdir()
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    for path in (tmp_path / "book.epub", tmp_path / "books" / ".." / "book.epub"):
+        status, error = request_json(
+            socket_path,
+            "POST",
+            "/jobs",
+            body=json.dumps({"path": str(path)}).encode(),
+            content_type="application/json",
+        )
+        assert status == 403
+        assert "path root" in error["error"]
+
+
+def test_stats(tmp_path: Path, server: tuple[ConversionService, Path]) -> None:
+    _, socket_path = server
+    (tmp_path / "books").mkdir()
+    generate_epub(PRESETS["small"], tmp_path / "books" / "book.epub")
+    status, _ = request(
+        socket_path,
+        "POST",
+        "/convert",
+        json.dumps({"path": str(tmp_path / "books" / "book.epub")}).encode(),
+        "application/json",
+    )
+    assert status == 200
+    request(socket_path, "POST", "/convert", b"not a zip")
+
+    status, stats = request_json(socket_path, "GET", "/stats")
+    assert status == 200
+    assert stats["queue_depth"] == 0
+    assert stats["running"] == 0
+    assert stats["completed"] == 1
+    assert stats["failed"] == 1
+    assert stats["workers"] == 1
+    assert stats["uptime"] > 0
+    assert stats["latency"].keys() == {"p50", "p90", "p95", "p99"}
+    assert all(latency > 0 for latency in stats["latency"].values())
+    assert stats["throughput"] == 2
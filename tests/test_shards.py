@@ -0,0 +1,61 @@
+import concurrent.futures
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from kpfgen import kdf as kdf_module
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+from kpfgen.kdf import KDF
+from kpfgen.options import ConversionOptions
+from kpfgen.static_render import StaticDriver
+from kpfgen.verify import verify_kdf
+
+
+def build_kdf(tmp_path: Path, name: str, options: ConversionOptions) -> Path:
+    epub_path = tmp_path / "book.epub"
+    epub_dir = tmp_path / "epub"
+    if not epub_dir.exists():
+        generate_epub(PRESETS["medium"], epub_path)
+        extract_epub(epub_path, epub_dir)
+    db_path = tmp_path / name / "book.kdf"
+    db_path.parent.mkdir()
+    KDF(webdriver=StaticDriver(), options=options).create_kdf(epub_dir, db_path)
+    return db_path
+
+
+def fragment_counts(db_path: Path) -> dict[str, int]:
+    with sqlite3.connect(db_path) as conn:
+        return dict(
+            conn.execute(
+                "SELECT value, count(*) FROM fragment_properties "
+                "WHERE key = 'element_type' GROUP BY value"
+            )
+        )
+
+
+@pytest.mark.parametrize("pipeline_workers", [0, 2])
+def test_shards(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, pipeline_workers: int
+) -> None:
+    # render shards in threads with the static renderer instead of processes
+    # with Firefox
+    monkeypatch.setattr(
+        concurrent.futures,
+        "ProcessPoolExecutor",
+        lambda workers, mp_context: concurrent.futures.ThreadPoolExecutor(workers),
+    )
+    render_shard = kdf_module.render_shard
+    monkeypatch.setattr(
+        kdf_module, "render_shard", lambda task: render_shard(task, StaticDriver())
+    )
+    sequential_path = build_kdf(tmp_path, "sequential", ConversionOptions())
+    shards_path = build_kdf(
+        tmp_path,
+        "shards",
+        ConversionOptions(processes=3, pipeline_workers=pipeline_workers),
+    )
+    assert verify_kdf(shards_path) == []
+    assert fragment_counts(shards_path) == fragment_counts(sequential_path)
+    assert list(shards_path.parent.glob("shard*.kdf")) == []
@@ -0,0 +1,42 @@
+from pathlib import Path
+
+import pytest
+
+from kpfgen.benchmark import PRESETS, generate_epub
+from kpfgen.epub import extract_epub
+from kpfgen.kdf import KDF
+from kpfgen.main import WORK_DIR_NAME, create_kpf
+from kpfgen.options import ConversionOptions
+from kpfgen.static_render import StaticDriver
+
+
+def static_kdf(work_dir: Path) -> KDF:
+    return KDF(webdriver=StaticDriver(), options=ConversionOptions(work_dir=work_dir))
+
+
+def test_work_dir_keeps_other_files(tmp_path: Path) -> None:
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    epub_dir = tmp_path / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    (tmp_path / "kpf").mkdir()
+    (tmp_path / "checkpoint.json").write_text("{}")
+    files = sorted(tmp_path.rglob("*"))
+
+    create_kpf(epub_dir, kdf=static_kdf(tmp_path))
+    create_kpf(tmp_path / "book.epub", kdf=static_kdf(tmp_path))
+    assert sorted(tmp_path.rglob("*")) == sorted(
+        files + [tmp_path / "book.kpf", tmp_path / "epub.kpf"]
+    )
+
+
+def test_work_dir_refuses_foreign_dirs(tmp_path: Path) -> None:
+    generate_epub(PRESETS["small"], tmp_path / "book.epub")
+    epub_dir = tmp_path / WORK_DIR_NAME / "epub"
+    extract_epub(tmp_path / "book.epub", epub_dir)
+    # not created by kpfgen
+    with pytest.raises(ValueError):
+        create_kpf(tmp_path / "book.epub", kdf=static_kdf(tmp_path))
+    # EPUB directory is in the work directory
+    with pytest.raises(ValueError):
+        create_kpf(epub_dir, kdf=static_kdf(tmp_path))
+    assert (epub_dir / "META-INF" / "container.xml").is_file()